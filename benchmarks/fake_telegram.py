@@ -0,0 +1,77 @@
+import collections
+import itertools
+import json
+import time
+from aiohttp import web
+
+
+class FakeTelegram:
+    """Local stand-in for Bot API answering methods used by the bot"""
+
+    def __init__(self) -> None:
+        self.calls = collections.Counter()
+        self.uploads = 0
+        self.invalid_file_ids: set[str] = set()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.method)
+        return app
+
+    async def method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type.startswith('multipart/'):
+            params = {}
+            async for part in await request.multipart():
+                if part.filename is None:
+                    params[part.name] = await part.text()
+                else:
+                    self.uploads += 1
+                    await part.read()
+        else:
+            params = dict(await request.post())
+        if self._sent_file_ids(method, params) & self.invalid_file_ids:
+            return web.json_response({
+                'ok': False,
+                'error_code': 400,
+                'description': 'Bad Request: wrong file identifier/HTTP URL '
+                               'specified',
+            }, status=400)
+
+        result = True
+        if method in ('sendMessage', 'sendPhoto'):
+            result = self._message(params)
+        if method == 'sendPhoto':
+            result['photo'] = self._photo()
+        if method == 'sendMediaGroup':
+            result = [{**self._message(params), 'photo': self._photo()}
+                      for _ in json.loads(params['media'])]
+        return web.json_response({'ok': True, 'result': result})
+
+    @staticmethod
+    def _sent_file_ids(method: str, params: dict) -> set[str]:
+        if method == 'sendPhoto':
+            return {params.get('photo')}
+        if method == 'sendMediaGroup':
+            return {media['media'] for media in json.loads(params['media'])}
+        return set()
+
+    def _photo(self) -> list[dict]:
+        file_id = 'photo_{}'.format(next(self._file_ids))
+        return [{
+            'file_id': file_id,
+            'file_unique_id': file_id,
+            'width': 320,
+            'height': 320,
+        }]
+
+    def _message(self, params: dict) -> dict:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
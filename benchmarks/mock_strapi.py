@@ -0,0 +1,279 @@
+import collections
+from aiohttp import web
+
+PICTURE_BYTES = b'\xff\xd8\xff\xe0' + b'\x00' * 20 * 1024
+
+
+class MockStrapi:
+    """
+    Local stand-in for strapi REST API with catalog and cart fixtures,
+     counts every request it serves
+    """
+
+    def __init__(self, products: int = 100, cart_lines: int = 5,
+                 users: int = 0) -> None:
+        """
+        :param products: count of products in catalog
+        :param cart_lines: count of lines in carts created for users
+        :param users: telegram ids 1..users get a filled cart up front
+        """
+        self.calls = collections.Counter()
+        self.products = {
+            id_product: self._product(id_product)
+            for id_product in range(1, products + 1)
+        }
+        self.carts: dict[int, dict] = {}
+        self.lines: dict[int, dict] = {}
+        self.orders: dict[str, dict] = {}
+        # answers of carts/add-product by idempotency key
+        self.upserts: dict[str, dict] = {}
+        for id_tg in range(1, users + 1):
+            id_cart = self._create_cart(id_tg)
+            for id_product in range(1, min(cart_lines, products) + 1):
+                self._create_line(id_cart, id_product, 1)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._count])
+        app.router.add_get('/api/products', self.products_list)
+        app.router.add_get('/api/products/{id}', self.product_detail)
+        app.router.add_get('/uploads/{name}', self.picture)
+        app.router.add_get('/api/carts', self.carts_list)
+        app.router.add_post('/api/carts', self.carts_create)
+        app.router.add_post('/api/carts/add-product', self.carts_add_product)
+        app.router.add_post('/api/carts/checkout', self.carts_checkout)
+        app.router.add_put('/api/carts/{id}', self.carts_update)
+        app.router.add_get('/api/quantity-products', self.lines_list)
+        app.router.add_post('/api/quantity-products', self.lines_create)
+        app.router.add_put('/api/quantity-products/{id}', self.lines_update)
+        app.router.add_delete('/api/quantity-products/{id}',
+                              self.lines_delete)
+        return app
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler):
+        self.calls['{} {}'.format(
+            request.method,
+            request.match_info.route.resource.canonical
+            if request.match_info.route.resource else request.path)] += 1
+        return await handler(request)
+
+    async def products_list(self, request: web.Request) -> web.Response:
+        products = list(self.products.values())
+        page = int(request.query.get('pagination[page]', 1))
+        page_size = int(request.query.get('pagination[pageSize]', 25))
+        fields = [value for key, value in request.query.items()
+                  if key.startswith('fields[')]
+        data = products[(page - 1) * page_size:page * page_size]
+        populate = any(key.startswith('populate[picture]')
+                       for key in request.query)
+        if fields:
+            data = [
+                {'id': product['id'],
+                 'attributes': {field: product['attributes'][field]
+                                for field in fields}}
+                for product in data
+            ]
+            if populate:
+                for product in data:
+                    product['attributes']['picture'] = self.products[
+                        product['id']]['attributes']['picture']
+        else:
+            data = [self._without_picture(product) for product in data]
+        return web.json_response({
+            'data': data,
+            'meta': {'pagination': {
+                'page': page,
+                'pageSize': page_size,
+                'pageCount': -(-len(products) // page_size),
+                'total': len(products),
+            }}
+        })
+
+    async def product_detail(self, request: web.Request) -> web.Response:
+        product = self.products.get(int(request.match_info['id']))
+        if product is None:
+            raise web.HTTPNotFound()
+        return web.json_response({'data': product, 'meta': {}})
+
+    async def picture(self, request: web.Request) -> web.Response:
+        return web.Response(body=PICTURE_BYTES, content_type='image/jpeg')
+
+    async def carts_list(self, request: web.Request) -> web.Response:
+        id_tg = request.query.get('filters[id_tg][$eq]')
+        email = request.query.get('filters[email][$eq]')
+        carts = [
+            cart for cart in self.carts.values()
+            if cart['published']
+            and (id_tg is None or str(cart['id_tg']) == id_tg)
+            and (email is None or cart.get('email') == email)
+        ]
+        return web.json_response({
+            'data': [self._cart(cart) for cart in carts],
+            'meta': {}
+        })
+
+    async def carts_create(self, request: web.Request) -> web.Response:
+        data = (await request.json())['data']
+        id_cart = self._create_cart(data.get('id_tg'))
+        self.carts[id_cart].update(
+            {key: value for key, value in data.items() if key != 'id_tg'})
+        return web.json_response({'data': self._cart(self.carts[id_cart])})
+
+    async def carts_update(self, request: web.Request) -> web.Response:
+        cart = self.carts.get(int(request.match_info['id']))
+        if cart is None:
+            raise web.HTTPNotFound()
+        data = (await request.json())['data']
+        if 'publishedAt' in data:
+            cart['published'] = data['publishedAt'] is not None
+        cart.update({key: data[key] for key in ('email', 'total_price')
+                     if key in data})
+        return web.json_response({'data': self._cart(cart)})
+
+    async def carts_add_product(self, request: web.Request) -> web.Response:
+        key = request.headers.get('Idempotency-Key')
+        if key in self.upserts:
+            return web.json_response({'data': self.upserts[key]})
+        data = (await request.json())['data']
+        carts = [cart for cart in self.carts.values()
+                 if cart['id_tg'] == data['id_tg'] and cart['published']]
+        id_cart = carts[0]['id'] if carts else self._create_cart(
+            data['id_tg'])
+        for line in self.lines.values():
+            if line['cart'] == id_cart and line['product'] == data['product']:
+                line['quantity'] += data['increment']
+                break
+        else:
+            line = self.lines[self._create_line(
+                id_cart, data['product'], data['increment'])]
+        if line['quantity'] <= 0:
+            del self.lines[line['id']]
+            line['quantity'] = 0
+        upsert = {
+            'cart': id_cart,
+            'quantity_product': line['id'],
+            'quantity': line['quantity'],
+        }
+        if key is not None:
+            self.upserts[key] = upsert
+        return web.json_response({'data': upsert})
+
+    async def carts_checkout(self, request: web.Request) -> web.Response:
+        key = request.headers.get('Idempotency-Key')
+        if key in self.orders:
+            return web.json_response({'data': self.orders[key]})
+        data = (await request.json())['data']
+        cart = self.carts.get(data['cart'])
+        if (cart is None or not cart['published']
+                or cart['id_tg'] != data['id_tg']
+                or not any(line['cart'] == cart['id']
+                           for line in self.lines.values())):
+            raise web.HTTPBadRequest()
+        cart.update(published=False, email=data['email'],
+                    total_price=data['total_price'])
+        order = {'cart': cart['id'], 'email': data['email'],
+                 'total_price': data['total_price']}
+        if key is not None:
+            self.orders[key] = order
+        return web.json_response({'data': order})
+
+    async def lines_list(self, request: web.Request) -> web.Response:
+        id_cart = request.query.get('filters[cart][id][$eq]')
+        id_product = request.query.get('filters[product][id][$eq]')
+        lines = [
+            line for line in self.lines.values()
+            if (id_cart is None or str(line['cart']) == id_cart)
+            and (id_product is None or str(line['product']) == id_product)
+        ]
+        return web.json_response({
+            'data': [self._line(line) for line in lines],
+            'meta': {}
+        })
+
+    async def lines_create(self, request: web.Request) -> web.Response:
+        data = (await request.json())['data']
+        id_line = self._create_line(data.get('cart'), data['product'],
+                                    data['quantity'])
+        return web.json_response({'data': self._line(self.lines[id_line])})
+
+    async def lines_update(self, request: web.Request) -> web.Response:
+        line = self.lines.get(int(request.match_info['id']))
+        if line is None:
+            raise web.HTTPNotFound()
+        data = (await request.json())['data']
+        line['quantity'] = data.get('quantity', line['quantity'])
+        return web.json_response({'data': self._line(line)})
+
+    async def lines_delete(self, request: web.Request) -> web.Response:
+        line = self.lines.pop(int(request.match_info['id']), None)
+        if line is None:
+            raise web.HTTPNotFound()
+        return web.json_response({'data': self._line(line)})
+
+    def _create_cart(self, id_tg: int) -> int:
+        id_cart = len(self.carts) + 1
+        self.carts[id_cart] = {'id': id_cart, 'id_tg': id_tg,
+                               'published': True}
+        return id_cart
+
+    def _create_line(self, id_cart: int | None, id_product: int,
+                     quantity: int) -> int:
+        id_line = max(self.lines, default=0) + 1
+        self.lines[id_line] = {'id': id_line, 'cart': id_cart,
+                               'product': id_product, 'quantity': quantity}
+        return id_line
+
+    def _cart(self, cart: dict) -> dict:
+        lines = [line for line in self.lines.values()
+                 if line['cart'] == cart['id']]
+        return {
+            'id': cart['id'],
+            'attributes': {
+                'id_tg': cart['id_tg'],
+                'quantity_products': {
+                    'data': [self._line(line) for line in lines]
+                },
+            }
+        }
+
+    def _line(self, line: dict) -> dict:
+        return {
+            'id': line['id'],
+            'attributes': {
+                'quantity': line['quantity'],
+                'product': {
+                    'data': self._without_picture(
+                        self.products[line['product']])
+                },
+            }
+        }
+
+    @staticmethod
+    def _without_picture(product: dict) -> dict:
+        attributes = dict(product['attributes'])
+        attributes.pop('picture')
+        return {'id': product['id'], 'attributes': attributes}
+
+    @staticmethod
+    def _product(id_product: int) -> dict:
+        return {
+            'id': id_product,
+            'attributes': {
+                'title': 'Товар {}'.format(id_product),
+                'description': 'Описание товара {} '.format(id_product) * 5,
+                'price': 100 + id_product,
+                'state': 'available',
+                'picture': {'data': [{
+                    'id': id_product,
+                    'attributes': {'formats': {'small': {
+                        'hash': 'picture_{}'.format(id_product),
+                        'name': 'picture_{}.jpg'.format(id_product),
+                        'url': '/uploads/picture_{}.jpg'.format(id_product),
+                    }}}
+                }]},
+            }
+        }
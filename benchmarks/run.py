@@ -0,0 +1,263 @@
+"""
+Replays synthetic user sessions through the real shop router and
+StrapiCartsMiddleware against local strapi and Bot API stand-ins.
+
+    python -m benchmarks.run --products 1000 --users 100 --rounds 3
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp.test_utils import TestServer
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.mock_strapi import MockStrapi
+from redis.asyncio import Redis
+from memory_redis import MemoryRedis
+from metrics import metrics
+from callbackdata_factory.callbacks import (ProductCallback,
+                                            PaginatorCallback,
+                                            AddToShoppingCartCallback,
+                                            ChangeQuantityCallback,
+                                            MyShoppingCartCallback,
+                                            PageGalleryCallback,
+                                            PayCallback)
+
+
+class ParseTimeSink:
+    """Sums time spent validating strapi responses into models"""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.responses = 0
+
+    def observe(self, name: str, value: float,
+                labels: dict[str, str]) -> None:
+        if name == 'strapi_validate_seconds':
+            self.seconds += value
+            self.responses += 1
+
+
+STEPS = ('start', 'paginate', 'gallery', 'search', 'detail', 'add_to_cart',
+         'view_cart', 'increment', 'pay', 'email', 'checkout')
+
+
+def message_update(id_update: int, id_tg: int, text: str) -> dict:
+    return {
+        'update_id': id_update,
+        'message': {
+            'message_id': id_update,
+            'date': int(time.time()),
+            'chat': {'id': id_tg, 'type': 'private'},
+            'from': {'id': id_tg, 'is_bot': False, 'first_name': 'bench'},
+            'text': text,
+        }
+    }
+
+
+def callback_update(id_update: int, id_tg: int, data: str) -> dict:
+    return {
+        'update_id': id_update,
+        'callback_query': {
+            'id': str(id_update),
+            'chat_instance': str(id_tg),
+            'from': {'id': id_tg, 'is_bot': False, 'first_name': 'bench'},
+            'data': data,
+            'message': {
+                'message_id': id_update,
+                'date': int(time.time()),
+                'chat': {'id': id_tg, 'type': 'private'},
+                'text': 'Пожалуйста выберите:',
+            },
+        }
+    }
+
+
+def session_steps(id_tg: int, products: int,
+                  page_size: int) -> list[tuple[str, str, str]]:
+    """Step name, update kind and payload of one shopping session"""
+    id_product = id_tg % products + 1
+    last_page = max(-(-products // page_size), 1)
+    return [
+        ('start', 'message', '/start'),
+        ('paginate', 'callback', PaginatorCallback(
+            current_page=1, last_page=last_page,
+            next=True, back=False).pack()),
+        ('gallery', 'callback', PageGalleryCallback(
+            page=min(2, last_page)).pack()),
+        ('search', 'message', 'товар {}'.format(id_product)),
+        ('detail', 'callback', ProductCallback(id=id_product).pack()),
+        ('add_to_cart', 'callback', AddToShoppingCartCallback(
+            id_product=id_product).pack()),
+        ('view_cart', 'callback', MyShoppingCartCallback(
+            id_user=id_tg).pack()),
+        ('increment', 'callback', ChangeQuantityCallback(
+            id_product=id_product, delta=1).pack()),
+        ('pay', 'callback', PayCallback(pay=True).pack()),
+        ('email', 'message', 'user{}@mail.ru'.format(id_tg)),
+        ('checkout', 'message', 'Да'),
+    ]
+
+
+def percentile(values: list[float], percent: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100,
+                                method='inclusive')[int(percent) - 1]
+
+
+async def run(products: int, users: int, rounds: int, page_size: int,
+              cart_lines: int, redis_url: str | None,
+              fsm_storage: str = 'redis',
+              trace_memory: bool = False) -> dict:
+    os.environ['PAGINATION'] = str(page_size)
+    image_dir = tempfile.TemporaryDirectory()
+    os.environ['IMAGE_CACHE_DIR'] = image_dir.name
+    parse_time = ParseTimeSink()
+    metrics.configure(enabled=True, sinks=[parse_time])
+
+    mock_strapi = MockStrapi(products=products, cart_lines=cart_lines,
+                             users=users)
+    fake_telegram = FakeTelegram()
+    strapi_server = TestServer(mock_strapi.create_app())
+    telegram_server = TestServer(fake_telegram.create_app())
+    await strapi_server.start_server()
+    await telegram_server.start_server()
+
+    os.environ['API_STRAPI_URL'] = str(strapi_server.make_url('/api/'))
+    os.environ['STRAPI_PRODUCT_TOKEN'] = 'bench'
+    os.environ['FSM_STORAGE'] = fsm_storage
+    from main import create_dispatcher, create_storage, create_strapi
+
+    redis = Redis.from_url(redis_url) if redis_url else MemoryRedis()
+    storage = create_storage(redis)
+    strapi = create_strapi()
+    dp = create_dispatcher(storage, strapi, redis)
+    bot = Bot('42:bench', session=AiohttpSession(
+        api=TelegramAPIServer.from_base(
+            str(telegram_server.make_url('')).rstrip('/'))))
+
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    # background startup loads are not counted against the first steps
+    await dp['catalog_index'].ready()
+    await dp['image_cache'].ready()
+    latencies = {step: [] for step in STEPS}
+    strapi_calls = {step: 0 for step in STEPS}
+    id_updates = iter(range(1, 10 ** 9))
+
+    async def feed(step: str, id_tg: int, kind: str, payload: str) -> None:
+        if kind == 'message':
+            update = message_update(next(id_updates), id_tg, payload)
+        else:
+            update = callback_update(next(id_updates), id_tg, payload)
+        started = time.perf_counter()
+        await dp.feed_raw_update(bot, update)
+        latencies[step].append(time.perf_counter() - started)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        for _ in range(rounds):
+            sessions = [session_steps(id_tg, products, page_size)
+                        for id_tg in range(1, users + 1)]
+            for index, step in enumerate(STEPS):
+                calls = mock_strapi.total_calls
+                await asyncio.gather(*(
+                    feed(step, id_tg, *sessions[id_tg - 1][index][1:])
+                    for id_tg in range(1, users + 1)))
+                strapi_calls[step] += mock_strapi.total_calls - calls
+    finally:
+        elapsed = time.perf_counter() - started
+        traced_peak = None
+        if trace_memory:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+        await bot.session.close()
+        await strapi_server.close()
+        await telegram_server.close()
+        image_dir.cleanup()
+
+    updates = sum(len(values) for values in latencies.values())
+    return {
+        'steps': {
+            step: {
+                'updates': len(latencies[step]),
+                'p50': percentile(latencies[step], 50) * 1000,
+                'p95': percentile(latencies[step], 95) * 1000,
+                'p99': percentile(latencies[step], 99) * 1000,
+                'strapi_calls': strapi_calls[step] / len(latencies[step]),
+            }
+            for step in STEPS
+        },
+        'updates': updates,
+        'elapsed': elapsed,
+        'throughput': updates / elapsed,
+        'strapi_calls': mock_strapi.total_calls / updates,
+        'telegram_calls': sum(fake_telegram.calls.values()) / updates,
+        'redis_calls': (redis.round_trips / updates
+                        if isinstance(redis, MemoryRedis) else None),
+        'parse_ms': parse_time.seconds * 1000,
+        'parsed_responses': parse_time.responses,
+        'peak_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'traced_peak_mb': (traced_peak / 1024 / 1024
+                           if traced_peak is not None else None),
+    }
+
+
+def print_report(report: dict) -> None:
+    print('{:<12} {:>8} {:>9} {:>9} {:>9} {:>11}'.format(
+        'step', 'updates', 'p50 ms', 'p95 ms', 'p99 ms', 'strapi/upd'))
+    for step, row in report['steps'].items():
+        print('{:<12} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>11.2f}'.format(
+            step, row['updates'], row['p50'], row['p95'], row['p99'],
+            row['strapi_calls']))
+    print('{updates} updates in {elapsed:.2f}s, {throughput:.0f} updates/s, '
+          '{strapi_calls:.2f} strapi calls/update, '
+          '{telegram_calls:.2f} telegram calls/update'.format(**report))
+    if report['redis_calls'] is not None:
+        print('{redis_calls:.2f} redis round trips/update'.format(**report))
+    print('parse {parse_ms:.2f}ms for {parsed_responses} strapi responses, '
+          'peak rss {peak_rss_mb:.1f}MB'.format(**report), end='')
+    if report['traced_peak_mb'] is not None:
+        print(', peak traced {traced_peak_mb:.1f}MB'.format(**report), end='')
+    print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--products', type=int, default=100)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--page-size', type=int, default=5)
+    parser.add_argument('--cart-lines', type=int, default=5)
+    parser.add_argument('--redis-url', default=None,
+                        help='use real redis instead of in-memory storage')
+    parser.add_argument('--fsm-storage', default='redis',
+                        choices=('redis', 'lru', 'memory'),
+                        help='FSM_STORAGE of the bot')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak python memory with tracemalloc')
+    args = parser.parse_args()
+
+    print_report(asyncio.run(run(
+        products=args.products,
+        users=args.users,
+        rounds=args.rounds,
+        page_size=args.page_size,
+        cart_lines=args.cart_lines,
+        redis_url=args.redis_url,
+        fsm_storage=args.fsm_storage,
+        trace_memory=args.trace_memory)))
+
+
+if __name__ == '__main__':
+    main()
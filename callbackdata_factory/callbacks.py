@@ -5,6 +5,14 @@ class ProductCallback(CallbackData, prefix='Product'):
     id: int
 
 
+class GalleryCallback(CallbackData, prefix='Gallery'):
+    id_product: int
+
+
+class PageGalleryCallback(CallbackData, prefix='Page_gallery'):
+    page: int
+
+
 class BackCallback(CallbackData, prefix='Back'):
     back: bool
 
@@ -17,6 +25,11 @@ class RemoveProductCartCallback(CallbackData, prefix='Remove'):
     remove_id_quantity_product: int
 
 
+class ChangeQuantityCallback(CallbackData, prefix='Quantity'):
+    id_product: int
+    delta: int
+
+
 class MyShoppingCartCallback(CallbackData, prefix='Shopping_cart'):
     id_user: int
 
@@ -26,8 +39,6 @@ class PayCallback(CallbackData, prefix='pay'):
 
 
 class PaginatorCallback(CallbackData, prefix='page_'):
-    start_page: int
-    end_page: int
     current_page: int
     last_page: int
     next: bool
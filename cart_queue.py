@@ -0,0 +1,370 @@
+import asyncio
+import json
+import logging
+import uuid
+import aiohttp
+from aiogram import Bot
+from redis.asyncio import Redis
+from cart_store import CartStore
+from strapi import Strapi, StrapiUnavailable, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# prolong lock only while it is held by the token
+RENEW_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# delete lock only while it is held by the token
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class CartWriteQueue:
+    """
+    Cart changes acknowledged right away and written to strapi in
+    background. Changes are kept in a redis list per user, so they survive
+    restarts and are applied in order. Consecutive quantity changes of one
+    product are merged, failures are reported to the user by message.
+    """
+
+    def __init__(self, redis: Redis, strapi: Strapi, cart_store: CartStore,
+                 attempts: int = 3, retry_delay: float = 1.0,
+                 lock_ttl: int = 60, wait_timeout: float = 5.0,
+                 poll_interval: float = 0.05,
+                 prefix: str = 'cart_queue') -> None:
+        """
+        :param redis: redis client, the one used by RedisStorage
+        :param strapi: client applying changes
+        :param cart_store: cart snapshots updated after strapi
+        :param attempts: attempts of a change failed with connection
+         error, timeout or 5xx before it is dropped
+        :param retry_delay: seconds between attempts, doubled every time
+        :param lock_ttl: seconds a process owns the queue of a user
+         without renewing the lock, the lock keeps one writer per user
+         across processes and is renewed every third of it while
+         changes are written
+        :param wait_timeout: max seconds wait() waits for queued changes
+        :param poll_interval: seconds between checks of wait() while
+         changes are written by another process
+        :param prefix: prefix of redis keys
+        """
+        self._redis = redis
+        self._strapi = strapi
+        self._cart_store = cart_store
+        self._attempts = attempts
+        self._retry_delay = retry_delay
+        self._lock_ttl = lock_ttl
+        self._wait_timeout = wait_timeout
+        self._poll_interval = poll_interval
+        self._prefix = prefix
+        self._token = uuid.uuid4().hex
+        self._bot: Bot | None = None
+        self._drains: dict[int, asyncio.Task] = {}
+        # users with changes queued while their drain was running
+        self._again: set[int] = set()
+
+    def _key(self, id_tg: int) -> str:
+        return '{prefix}:{id_tg}'.format(prefix=self._prefix, id_tg=id_tg)
+
+    def _lock_key(self, id_tg: int) -> str:
+        return '{prefix}:{id_tg}:lock'.format(prefix=self._prefix,
+                                              id_tg=id_tg)
+
+    @property
+    def _users_key(self) -> str:
+        return '{prefix}:users'.format(prefix=self._prefix)
+
+    async def start(self, bot: Bot) -> None:
+        """Resume changes left by stopped processes, called on startup"""
+        self._bot = bot
+        for id_tg in await self._redis.smembers(self._users_key):
+            self._wake(int(id_tg))
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Give running writes time to finish, the rest stays queued"""
+        if self._drains:
+            await asyncio.wait(list(self._drains.values()), timeout=timeout)
+        for task in list(self._drains.values()):
+            task.cancel()
+
+    async def change_quantity(self, id_tg: int, product_id: int,
+                              delta: int = 1) -> None:
+        """
+        Queue changing quantity of product in the user cart
+        :param id_tg: telegram id user
+        :param product_id: id of product
+        :param delta: added quantity, negative to take away
+        :return: None
+        """
+        await self._push(id_tg, {'op': 'change', 'product': product_id,
+                                 'delta': delta, 'key': uuid.uuid4().hex})
+
+    async def remove_product(self, id_tg: int,
+                             id_quantity_product: int) -> None:
+        """
+        Queue removing quantity-product line from the user cart
+        :param id_tg: telegram id user
+        :param id_quantity_product: id of quantity-product line
+        :return: None
+        """
+        await self._push(id_tg, {'op': 'remove',
+                                 'quantity_product': id_quantity_product})
+
+    async def wait(self, id_tg: int, timeout: float | None = None) -> bool:
+        """
+        Wait until queued changes of user are written by any process.
+         The queue in redis is checked, a change may be written by another
+         replica or wait for the lock of a crashed one
+        :param id_tg: telegram id user
+        :param timeout: max seconds, default wait_timeout
+        :return: False when changes are still queued
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (
+            self._wait_timeout if timeout is None else timeout)
+        key = self._key(id_tg)
+        while await self._redis.llen(key):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.warning('Cart queue of %s is not written in time',
+                               id_tg)
+                return False
+            drain = self._drains.get(id_tg)
+            if drain is None:
+                await asyncio.sleep(min(self._poll_interval, remaining))
+            else:
+                await asyncio.wait([drain], timeout=remaining)
+        return True
+
+    async def _push(self, id_tg: int, change: dict) -> None:
+        await self._redis.rpush(self._key(id_tg), json.dumps(change))
+        await self._redis.sadd(self._users_key, id_tg)
+        self._wake(id_tg)
+
+    def _wake(self, id_tg: int) -> None:
+        """Start writer of user queue unless it is running"""
+        if id_tg in self._drains:
+            self._again.add(id_tg)
+            return
+        task = asyncio.create_task(self._drain(id_tg))
+        self._drains[id_tg] = task
+        task.add_done_callback(lambda done: self._drain_done(id_tg, done))
+
+    def _drain_done(self, id_tg: int, task: asyncio.Task) -> None:
+        if self._drains.get(id_tg) is task:
+            del self._drains[id_tg]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Cart queue of %s stopped: %r',
+                         id_tg, task.exception())
+
+    async def _drain(self, id_tg: int) -> None:
+        """Apply queued changes of user until the queue is empty"""
+        key = self._key(id_tg)
+        while True:
+            self._again.discard(id_tg)
+            if not await self._redis.set(self._lock_key(id_tg), self._token,
+                                         nx=True, ex=self._lock_ttl):
+                # another process writes this cart, it empties the queue
+                await asyncio.sleep(self._retry_delay)
+                if await self._redis.llen(key):
+                    continue
+                break
+            renewal = asyncio.create_task(self._keep_lock(id_tg))
+            try:
+                raw_changes = await self._redis.lrange(key, 0, -1)
+                if raw_changes:
+                    for change, count in merge_changes(
+                            [json.loads(raw) for raw in raw_changes]):
+                        if change is not None:
+                            count = await self._apply_with_retries(
+                                id_tg, change, count)
+                        # an expired lock let another process read the
+                        # same changes, the queue is its now
+                        if (count is None
+                                or not await self._renew_lock(id_tg)):
+                            logger.error('Cart queue lock of %s lost', id_tg)
+                            return
+                        # applied changes are not replayed after restart
+                        await self._redis.ltrim(key, count, -1)
+                    continue
+            finally:
+                renewal.cancel()
+                await self._unlock(id_tg)
+
+            await self._redis.srem(self._users_key, id_tg)
+            # pushed while the set was updated
+            if await self._redis.llen(key) or id_tg in self._again:
+                await self._redis.sadd(self._users_key, id_tg)
+                continue
+            break
+
+    async def _keep_lock(self, id_tg: int) -> None:
+        """Renew lock while a slow change is written"""
+        while True:
+            await asyncio.sleep(self._lock_ttl / 3)
+            if not await self._renew_lock(id_tg):
+                return
+
+    async def _renew_lock(self, id_tg: int) -> bool:
+        """Prolong lock, False when another process owns it"""
+        return bool(await self._redis.eval(
+            RENEW_LOCK, 1, self._lock_key(id_tg), self._token,
+            self._lock_ttl))
+
+    async def _unlock(self, id_tg: int) -> None:
+        await self._redis.eval(RELEASE_LOCK, 1, self._lock_key(id_tg),
+                               self._token)
+
+    async def _apply_with_retries(self, id_tg: int, change: dict,
+                                  count: int) -> int | None:
+        """
+        Apply change, drop it and tell the user when it fails
+        :param count: queued changes merged into change
+        :return: queued changes it takes now, 1 once it is marked sent,
+         None when the lock was lost before it was sent
+        """
+        delay = self._retry_delay
+        lookup = True
+        for attempt in range(self._attempts):
+            try:
+                if change['op'] == 'change' and not change.get('sent'):
+                    change = await self._mark_sent(id_tg, change, count)
+                    if change is None:
+                        return None
+                    count = 1
+                    # the line was read just now
+                    lookup = False
+                await self._apply(id_tg, change, lookup=lookup)
+                return count
+            except Exception as error:
+                lookup = True
+                last = attempt + 1 >= self._attempts
+                if not last and (is_retryable(error) or
+                                 isinstance(error, StrapiUnavailable)):
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                    continue
+                logger.error('Cart change %s of %s failed: %r',
+                             change, id_tg, error)
+                # snapshot may show the change, reload it from strapi
+                await self._cart_store.drop(id_tg)
+                await self._notify(id_tg, change)
+                return count
+        return count
+
+    async def _mark_sent(self, id_tg: int, change: dict,
+                         count: int) -> dict | None:
+        """
+        Replace queued changes by the request about to be sent, a retry
+         or a replay after restart repeats it instead of adding delta
+         again: the upsert endpoint gets the same idempotency key,
+         otherwise the same quantity is written
+        :return: change marked sent, None when the lock was lost
+        """
+        change = {**change, 'sent': True}
+        # queued before changes got keys
+        change.setdefault('key', uuid.uuid4().hex)
+        if not self._strapi.cart_upsert:
+            async with self._strapi:
+                change['cart'], change['line'], change['quantity'] = (
+                    await self._strapi.plan_product_quantity(
+                        product_id=change['product'],
+                        user_id=id_tg,
+                        delta=change['delta']))
+        if not await self._renew_lock(id_tg):
+            return None
+        key = self._key(id_tg)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.ltrim(key, count, -1)
+            pipe.lpush(key, json.dumps(change))
+            await pipe.execute()
+        return change
+
+    async def _apply(self, id_tg: int, change: dict,
+                     lookup: bool = True) -> None:
+        """
+        :param lookup: a planned line missing in strapi is looked up,
+         an earlier attempt may have created it
+        """
+        async with self._strapi:
+            if change['op'] == 'change':
+                if 'quantity' in change:
+                    write = self._strapi.set_product_quantity(
+                        product_id=change['product'],
+                        user_id=id_tg,
+                        id_cart=change['cart'],
+                        id_quantity_product=change['line'],
+                        quantity=change['quantity'],
+                        lookup=lookup)
+                else:
+                    write = self._strapi.change_product_quantity(
+                        product_id=change['product'],
+                        user_id=id_tg,
+                        delta=change['delta'],
+                        idempotency_key=change['key'])
+                id_cart, id_quantity_product, quantity = await write
+                if id_quantity_product is None:
+                    return
+                if quantity > 0:
+                    await self._cart_store.put_product(
+                        id_tg=id_tg,
+                        id_cart=id_cart,
+                        id_quantity_product=id_quantity_product,
+                        product=await self._strapi.get_product_by_id(
+                            change['product']),
+                        quantity=quantity)
+                else:
+                    await self._cart_store.remove_product(
+                        id_tg, id_quantity_product)
+            elif change['op'] == 'remove':
+                try:
+                    await self._strapi.deleted_product(
+                        change['quantity_product'], user_id=id_tg)
+                except aiohttp.ClientResponseError as error:
+                    # removed before, e.g. change replayed after restart
+                    if error.status != 404:
+                        raise
+                await self._cart_store.remove_product(
+                    id_tg, change['quantity_product'])
+
+    async def _notify(self, id_tg: int, change: dict) -> None:
+        if self._bot is None:
+            return
+        text = ('Не удалось изменить количество товара, попробуйте еще раз'
+                if change['op'] == 'change' else
+                'Не удалось убрать товар из корзины, попробуйте еще раз')
+        try:
+            await self._bot.send_message(id_tg, text)
+        except Exception as error:
+            logger.warning('Failed to notify %s: %r', id_tg, error)
+
+
+def merge_changes(changes: list[dict]) -> list[tuple[dict | None, int]]:
+    """
+    Consecutive changes of one product become one change with sum of
+     deltas, None when they cancel out. A change marked sent may have
+     reached strapi, it is never merged
+    :return: merged change and count of queued changes it replaces
+    """
+    merged = []
+    for change in changes:
+        last = merged[-1][0] if merged else None
+        if (change['op'] == 'change' and last is not None
+                and last['op'] == 'change'
+                and not change.get('sent') and not last.get('sent')
+                and last['product'] == change['product']):
+            merged[-1] = ({**last, 'delta': last['delta'] + change['delta']},
+                          merged[-1][1] + 1)
+        else:
+            merged.append((change, 1))
+    return [(change if change['op'] != 'change' or change['delta'] else None,
+             count)
+            for change, count in merged]
@@ -0,0 +1,142 @@
+from redis.asyncio import Redis
+from strapi_model import (ShoppingCartStrapiModelList, ProductStrapiModel,
+                          Products, CartList, CartAttributes,
+                          QuantityProductsModelList,
+                          QuantityProductsAttributes,
+                          QuantityProductsCartAttributes)
+
+
+class CartStore:
+    """
+    Snapshot of user carts in redis, cart screens are rendered from it.
+    Cart changes are written through to the snapshot after strapi,
+    snapshot expires after ttl and is reconciled with strapi on next view
+    """
+
+    def __init__(self, redis: Redis, ttl: int = 600,
+                 checkout_ttl: int = 60, prefix: str = 'cart') -> None:
+        """
+        :param redis: redis client, the one used by RedisStorage
+        :param ttl: seconds before snapshot is reloaded from strapi
+        :param checkout_ttl: seconds a checkout is claimed, a little
+         more than strapi timeout of checkout with retries, so the claim
+         of a crashed process expires soon
+        :param prefix: prefix of redis keys
+        """
+        self._redis = redis
+        self._ttl = ttl
+        self._checkout_ttl = checkout_ttl
+        self._prefix = prefix
+
+    def _key(self, id_tg: int) -> str:
+        return '{prefix}:{id_tg}'.format(prefix=self._prefix, id_tg=id_tg)
+
+    async def get(self, id_tg: int) -> ShoppingCartStrapiModelList | None:
+        """
+        Get cart snapshot of user
+        :param id_tg: telegram id user
+        :return: carts as returned by Strapi.get_cart_by_filter or None
+        """
+        snapshot = await self._redis.get(self._key(id_tg))
+        if snapshot is None:
+            return None
+        return ShoppingCartStrapiModelList.model_validate_json(snapshot)
+
+    async def set(self, id_tg: int,
+                  carts: ShoppingCartStrapiModelList) -> None:
+        """
+        Save cart snapshot of user
+        :param id_tg: telegram id user
+        :param carts: carts loaded from strapi or changed snapshot
+        :return: None
+        """
+        await self._redis.set(self._key(id_tg), carts.model_dump_json(),
+                              ex=self._ttl)
+
+    async def drop(self, id_tg: int) -> None:
+        """Forget snapshot, e.g. after order completion"""
+        await self._redis.delete(self._key(id_tg))
+
+    def _checkout_key(self, idempotency_key: str) -> str:
+        return '{prefix}:checkout:{key}'.format(prefix=self._prefix,
+                                                key=idempotency_key)
+
+    async def claim_checkout(self, idempotency_key: str,
+                             ttl: int | None = None) -> bool:
+        """
+        Mark checkout as started, across all processes of the bot
+        :param idempotency_key: key of the checkout, e.g. user and cart id
+        :param ttl: seconds the key is remembered, default checkout_ttl
+        :return: False if checkout with this key is running or has just
+         been placed
+        """
+        return bool(await self._redis.set(
+            self._checkout_key(idempotency_key), 1, nx=True,
+            ex=self._checkout_ttl if ttl is None else ttl))
+
+    async def release_checkout(self, idempotency_key: str) -> None:
+        """Allow checkout again after it failed"""
+        await self._redis.delete(self._checkout_key(idempotency_key))
+
+    async def put_product(self, id_tg: int, id_cart: int,
+                          id_quantity_product: int,
+                          product: ProductStrapiModel,
+                          quantity: int) -> None:
+        """
+        Write added product into snapshot if user has one
+        :param id_tg: telegram id user
+        :param id_cart: id cart user
+        :param id_quantity_product: id of quantity-product line
+        :param product: added product
+        :param quantity: quantity saved in strapi
+        :return: None
+        """
+        carts = await self.get(id_tg)
+        if carts is None:
+            return
+
+        for cart in carts.data:
+            if cart.id == id_cart:
+                break
+        else:
+            cart = CartList(
+                id=id_cart,
+                attributes=CartAttributes(id_tg=id_tg))
+            carts.data.append(cart)
+        if cart.attributes.quantity_products is None:
+            cart.attributes.quantity_products = QuantityProductsModelList(
+                data=[])
+
+        line = QuantityProductsAttributes(
+            id=id_quantity_product,
+            attributes=QuantityProductsCartAttributes(
+                quantity=quantity,
+                product=ProductStrapiModel(data=Products(
+                    id=product.data.id,
+                    attributes=product.data.attributes.model_copy(
+                        update={'picture': None})))))
+        lines = cart.attributes.quantity_products.data
+        lines[:] = [old for old in lines if old.id != id_quantity_product]
+        lines.append(line)
+
+        await self.set(id_tg, carts)
+
+    async def remove_product(self, id_tg: int,
+                             id_quantity_product: int) -> None:
+        """
+        Remove quantity-product line from snapshot if user has one
+        :param id_tg: telegram id user
+        :param id_quantity_product: id of removed quantity-product
+        :return: None
+        """
+        carts = await self.get(id_tg)
+        if carts is None:
+            return
+
+        for cart in carts.data:
+            if cart.attributes.quantity_products is not None:
+                lines = cart.attributes.quantity_products.data
+                lines[:] = [line for line in lines
+                            if line.id != id_quantity_product]
+
+        await self.set(id_tg, carts)
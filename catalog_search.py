@@ -0,0 +1,301 @@
+import asyncio
+import bisect
+import logging
+import re
+import time
+from typing import NamedTuple
+import aiohttp
+from metrics import metrics
+from strapi import Strapi
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r'\w+')
+
+# shorter query words match whole tokens only, a prefix of one or two
+# letters matches most of the catalog
+MIN_PREFIX = 3
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(text.lower().replace('ё', 'е'))
+
+
+class SearchResult(NamedTuple):
+    id: int
+    title: str
+    description: str
+    price: int
+
+
+def product_tokens(product: SearchResult) -> tuple[frozenset, frozenset]:
+    """Tokens of title, tokens of title and description"""
+    title_tokens = frozenset(tokenize(product.title))
+    return title_tokens, title_tokens | frozenset(
+        tokenize(product.description))
+
+
+class TokenIndex:
+    """Product ids by token with sorted tokens for prefix lookup"""
+
+    def __init__(self) -> None:
+        self._postings: dict[str, set[int]] = {}
+        self._vocabulary: list[str] = []
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._vocabulary.clear()
+
+    def add(self, token: str, id_product: int, sort: bool = True) -> None:
+        """
+        :param sort: keep vocabulary sorted, False in bulk load
+         finished by sort()
+        """
+        ids = self._postings.get(token)
+        if ids is None:
+            self._postings[token] = {id_product}
+            if sort:
+                bisect.insort(self._vocabulary, token)
+        else:
+            ids.add(id_product)
+
+    def sort(self) -> None:
+        self._vocabulary = sorted(self._postings)
+
+    def discard(self, token: str, id_product: int) -> None:
+        ids = self._postings.get(token)
+        if ids is None:
+            return
+        ids.discard(id_product)
+        if not ids:
+            del self._postings[token]
+            index = bisect.bisect_left(self._vocabulary, token)
+            # vocabulary is not sorted yet in bulk load
+            if (index < len(self._vocabulary)
+                    and self._vocabulary[index] == token):
+                del self._vocabulary[index]
+
+    def find(self, words: list[str]) -> set[int]:
+        """
+        Ids having every word. Word with fewest ids is taken first, others
+         only filter it, so a broad word costs no union of its postings
+        """
+        matches = []
+        for word in words:
+            postings = self._prefix(word)
+            if not postings:
+                return set()
+            matches.append(postings)
+        if not matches:
+            return set()
+        matches.sort(key=lambda postings: sum(map(len, postings)))
+        first = matches[0]
+        found = first[0] if len(first) == 1 else set().union(*first)
+        for postings in matches[1:]:
+            found = set().union(*(found & ids for ids in postings))
+            if not found:
+                break
+        return found
+
+    def _prefix(self, word: str) -> list[set[int]]:
+        """Postings of tokens starting with word"""
+        if len(word) < MIN_PREFIX:
+            ids = self._postings.get(word)
+            return [ids] if ids else []
+        index = bisect.bisect_left(self._vocabulary, word)
+        postings = []
+        while (index < len(self._vocabulary)
+               and self._vocabulary[index].startswith(word)):
+            postings.append(self._postings[self._vocabulary[index]])
+            index += 1
+        return postings
+
+
+class CatalogIndex:
+    """
+    Inverted index of catalog titles and descriptions in process memory.
+    Every query word matches tokens it is a prefix of, products with all
+    words found are returned, title matches first. Built from strapi at
+    startup and on unknown catalog changes. A product webhook updates it
+    in place with the product reloaded from strapi, fields of the
+    payload are not trusted.
+    """
+
+    def __init__(self, strapi: Strapi, page_size: int = 100) -> None:
+        """
+        :param strapi: client loading the catalog, its invalidations
+         keep the index current
+        :param page_size: count products in one request of rebuild
+        """
+        self._strapi = strapi
+        self._page_size = page_size
+        self._products: dict[int, SearchResult] = {}
+        # sorted keys of _products
+        self._ids: list[int] = []
+        # product id -> tokens of title, tokens of title and description
+        self._tokens_of: dict[int, tuple[frozenset, frozenset]] = {}
+        self._tokens = TokenIndex()
+        self._title_tokens = TokenIndex()
+        self._rebuild: asyncio.Task | None = None
+        self._refreshes: set[asyncio.Task] = set()
+        # ids of products changed while rebuild was loading
+        self._pending: list[int] | None = None
+        strapi.add_catalog_listener(self.on_catalog_change)
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    async def start(self) -> None:
+        """Build index in background, called on startup"""
+        self._schedule_rebuild()
+
+    async def ready(self) -> None:
+        """Wait until running rebuild is over"""
+        while self._rebuild is not None and not self._rebuild.done():
+            await asyncio.wait([self._rebuild])
+
+    async def stop(self) -> None:
+        if self._rebuild is not None:
+            self._rebuild.cancel()
+        for task in list(self._refreshes):
+            task.cancel()
+
+    def search(self, query: str, limit: int = 50) -> list[SearchResult]:
+        """
+        Find products by words of query, strapi is not called
+        :param query: text typed by user
+        :param limit: max count of results
+        :return: products found by title first, then by id
+        """
+        started = time.perf_counter()
+        words = tokenize(query)
+        in_title = self._title_tokens.find(words)
+        ids = self._smallest(in_title, limit)
+        if len(ids) < limit:
+            found = self._tokens.find(words)
+            ids.extend(id_product for id_product in self._smallest(
+                found, limit + len(ids)) if id_product not in in_title)
+        results = [self._products[id_product] for id_product in ids[:limit]]
+        metrics.observe('search_seconds', time.perf_counter() - started)
+        return results
+
+    def _smallest(self, ids: set[int], limit: int) -> list[int]:
+        """Lowest ids, a large set is filtered along sorted catalog ids"""
+        if len(ids) * 64 < len(self._ids):
+            return sorted(ids)[:limit]
+        smallest = []
+        for id_product in self._ids:
+            if id_product in ids:
+                smallest.append(id_product)
+                if len(smallest) == limit:
+                    break
+        return smallest
+
+    def on_catalog_change(self, event: dict | None) -> None:
+        """Reload changed product in background, rebuild on other changes"""
+        entry = (event or {}).get('entry') or {}
+        if (event is None or event.get('model') != 'product'
+                or not isinstance(entry.get('id'), int)):
+            self._schedule_rebuild()
+            return
+        if self._pending is not None:
+            self._pending.append(entry['id'])
+        self._schedule_refresh(entry['id'])
+
+    def _schedule_refresh(self, id_product: int) -> None:
+        task = asyncio.create_task(self._refresh(id_product))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refresh_done)
+
+    async def _refresh(self, id_product: int) -> None:
+        """Index product as strapi has it now, unpublished one is removed"""
+        try:
+            async with self._strapi:
+                product = await self._strapi.get_product_by_id(id_product)
+        except aiohttp.ClientResponseError as error:
+            if error.status != 404:
+                raise
+            self.remove(id_product)
+            return
+        attributes = product.data.attributes
+        self.put(SearchResult(product.data.id, attributes.title,
+                              attributes.description, attributes.price))
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        self._refreshes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Search index update failed: %r', task.exception())
+
+    def put(self, product: SearchResult) -> None:
+        """Add product or replace its indexed text"""
+        self.remove(product.id)
+        bisect.insort(self._ids, product.id)
+        title_tokens, tokens = product_tokens(product)
+        self._products[product.id] = product
+        self._tokens_of[product.id] = (title_tokens, tokens)
+        for token in tokens:
+            self._tokens.add(token, product.id)
+        for token in title_tokens:
+            self._title_tokens.add(token, product.id)
+
+    def remove(self, id_product: int) -> None:
+        """Forget product, unknown ids are ignored"""
+        if self._products.pop(id_product, None) is not None:
+            index = bisect.bisect_left(self._ids, id_product)
+            if index < len(self._ids) and self._ids[index] == id_product:
+                del self._ids[index]
+        title_tokens, tokens = self._tokens_of.pop(id_product, ((), ()))
+        for token in tokens:
+            self._tokens.discard(token, id_product)
+        for token in title_tokens:
+            self._title_tokens.discard(token, id_product)
+
+    def _schedule_rebuild(self) -> None:
+        if self._rebuild is not None and not self._rebuild.done():
+            self._rebuild.cancel()
+        self._rebuild = asyncio.create_task(self._load())
+        self._rebuild.add_done_callback(self._rebuild_done)
+
+    async def _load(self) -> None:
+        """Replace index with catalog loaded from strapi"""
+        pending = self._pending = []
+        try:
+            async with self._strapi:
+                products = await self._strapi.get_search_products(
+                    page_size=self._page_size)
+        finally:
+            if self._pending is pending:
+                self._pending = None
+
+        # built aside, search uses the old index until it is complete
+        found: dict[int, SearchResult] = {}
+        tokens_of = {}
+        all_tokens, all_title_tokens = TokenIndex(), TokenIndex()
+        for product in products:
+            # offset paging repeats a product published during the load
+            if product.id in found:
+                continue
+            found[product.id] = SearchResult(
+                product.id, product.attributes.title,
+                product.attributes.description, product.attributes.price)
+            title_tokens, tokens = tokens_of[product.id] = product_tokens(
+                found[product.id])
+            for token in tokens:
+                all_tokens.add(token, product.id, sort=False)
+            for token in title_tokens:
+                all_title_tokens.add(token, product.id, sort=False)
+        all_tokens.sort()
+        all_title_tokens.sort()
+
+        self._products, self._tokens_of = found, tokens_of
+        self._tokens, self._title_tokens = all_tokens, all_title_tokens
+        self._ids = sorted(found)
+        # products changed after their page was loaded
+        for id_product in pending:
+            self._schedule_refresh(id_product)
+        logger.info('Search index built, %s products', len(self))
+
+    @staticmethod
+    def _rebuild_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Search index rebuild failed: %r', task.exception())
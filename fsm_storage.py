@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Mapping
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineRedisStorage(RedisStorage):
+    """
+    RedisStorage reading and writing state and data of a user together,
+     one round trip each. Reads renew ttl, so only idle users expire
+    """
+
+    async def get_record(self, key: StorageKey) -> tuple[str | None,
+                                                         dict[str, Any]]:
+        """
+        Get state and data in one round trip
+        :param key: storage key of user
+        :return: state and data
+        """
+        state_key = self.key_builder.build(key, 'state')
+        data_key = self.key_builder.build(key, 'data')
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for redis_key, ttl in ((state_key, self.state_ttl),
+                                   (data_key, self.data_ttl)):
+                if ttl is None:
+                    pipe.get(redis_key)
+                else:
+                    pipe.getex(redis_key, ex=ttl)
+            state, data = await pipe.execute()
+        if isinstance(state, bytes):
+            state = state.decode('utf-8')
+        if data is None:
+            return state, {}
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return state, self.json_loads(data)
+
+    async def set_record(self, key: StorageKey, state: str | None,
+                         data: Mapping[str, Any], state_changed: bool = True,
+                         data_changed: bool = True) -> None:
+        """
+        Write state and data in one MULTI/EXEC
+        :param key: storage key of user
+        :param state: state or None to delete it
+        :param data: data, empty to delete it
+        :param state_changed: False keeps stored state
+        :param data_changed: False keeps stored data
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._write_record(pipe, key, state, data,
+                               state_changed=state_changed,
+                               data_changed=data_changed)
+            await pipe.execute()
+
+    def _write_record(self, pipe: Pipeline, key: StorageKey,
+                      state: str | None, data: Mapping[str, Any],
+                      state_changed: bool, data_changed: bool) -> None:
+        """Queue commands of set_record in pipeline"""
+        if state_changed:
+            state_key = self.key_builder.build(key, 'state')
+            if state is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(state_key, state, ex=self.state_ttl)
+        if data_changed:
+            data_key = self.key_builder.build(key, 'data')
+            if not data:
+                pipe.delete(data_key)
+            else:
+                pipe.set(data_key, self.json_dumps(data), ex=self.data_ttl)
+
+
+class CachedRedisStorage(PipelineRedisStorage):
+    """
+    PipelineRedisStorage with LRU of hot users in process memory, reads
+    of a cached user cost no round trip. Redis stays the source of truth:
+    writes go through to it and publish the key in the same transaction,
+    other processes drop it from their cache. The cache is used only
+    while subscribed, entries are reread after cache_ttl, which also
+    renews redis ttl of active users
+    """
+
+    def __init__(self, redis: Redis, cache_size: int = 10000,
+                 cache_ttl: float = 60.0, channel: str = 'fsm_invalidate',
+                 **kwargs: Any) -> None:
+        """
+        :param redis: redis client
+        :param cache_size: max users kept in process memory
+        :param cache_ttl: seconds an entry is served without redis,
+         should be less than state_ttl and data_ttl
+        :param channel: redis channel of written keys
+        :param kwargs: arguments of RedisStorage
+        """
+        super().__init__(redis=redis, **kwargs)
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._channel = channel
+        self._token = uuid.uuid4().hex
+        # key -> (expire at, state, data)
+        self._cache: OrderedDict[str, tuple[float, str | None,
+                                            dict[str, Any]]] = OrderedDict()
+        # changes on every write, a read started before it is not cached
+        self._invalidations = 0
+        self._subscribed = False
+        self._listener: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """Subscribe to writes of other processes, called on startup"""
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        await super().close()
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self.get_record(key))[0]
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self.get_record(key))[1]
+
+    async def set_state(self, key: StorageKey,
+                        state: StateType = None) -> None:
+        await self.set_record(
+            key, state.state if isinstance(state, State) else state, {},
+            data_changed=False)
+
+    async def set_data(self, key: StorageKey,
+                       data: Mapping[str, Any]) -> None:
+        await self.set_record(key, None, data, state_changed=False)
+
+    async def get_record(self, key: StorageKey) -> tuple[str | None,
+                                                         dict[str, Any]]:
+        cache_key = self.key_builder.build(key)
+        entry = self._cache.get(cache_key)
+        if entry is not None and self._subscribed:
+            if entry[0] > time.monotonic():
+                self._cache.move_to_end(cache_key)
+                return entry[1], dict(entry[2])
+            del self._cache[cache_key]
+
+        invalidations = self._invalidations
+        state, data = await super().get_record(key)
+        if self._subscribed and invalidations == self._invalidations:
+            self._put(cache_key, state, data)
+        return state, dict(data)
+
+    async def set_record(self, key: StorageKey, state: str | None,
+                         data: Mapping[str, Any], state_changed: bool = True,
+                         data_changed: bool = True) -> None:
+        cache_key = self.key_builder.build(key)
+        # a failed write leaves the entry unknown
+        entry = self._cache.pop(cache_key, None)
+        self._invalidations += 1
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._write_record(pipe, key, state, data,
+                               state_changed=state_changed,
+                               data_changed=data_changed)
+            pipe.publish(self._channel, '{token} {key}'.format(
+                token=self._token, key=cache_key))
+            await pipe.execute()
+
+        if entry is not None or (state_changed and data_changed):
+            _, cached_state, cached_data = entry or (None, None, {})
+            self._put(cache_key,
+                      state if state_changed else cached_state,
+                      dict(data) if data_changed else cached_data)
+
+    def _put(self, cache_key: str, state: str | None,
+             data: dict[str, Any]) -> None:
+        self._cache[cache_key] = (time.monotonic() + self._cache_ttl,
+                                  state, data)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def _listen(self) -> None:
+        """Drop keys written by other processes, resubscribe on errors"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self._channel)
+                async for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self._subscribed = True
+                    if message['type'] != 'message':
+                        continue
+                    payload = message['data']
+                    if isinstance(payload, bytes):
+                        payload = payload.decode('utf-8')
+                    token, cache_key = payload.split(' ', 1)
+                    if token != self._token:
+                        self._invalidations += 1
+                        self._cache.pop(cache_key, None)
+            except Exception as error:
+                logger.warning('FSM cache unsubscribed: %r', error)
+            finally:
+                # writes may be missed until subscribed again
+                self._subscribed = False
+                self._cache.clear()
+                await pubsub.aclose()
+            await asyncio.sleep(1)
+
+
+async def get_record(storage: BaseStorage,
+                     key: StorageKey) -> tuple[str | None, dict[str, Any]]:
+    """State and data of user, in one call when storage supports it"""
+    if isinstance(storage, PipelineRedisStorage):
+        return await storage.get_record(key)
+    return await storage.get_state(key), await storage.get_data(key)
+
+
+async def set_record(storage: BaseStorage, key: StorageKey,
+                     state: str | None, data: Mapping[str, Any],
+                     state_changed: bool = True,
+                     data_changed: bool = True) -> None:
+    """Write state and data of user, in one call when storage supports it"""
+    if isinstance(storage, PipelineRedisStorage):
+        await storage.set_record(key, state, data,
+                                 state_changed=state_changed,
+                                 data_changed=data_changed)
+        return
+    if state_changed:
+        await storage.set_state(key, state)
+    if data_changed:
+        await storage.set_data(key, data)
+
+
+class BufferedFSMContext(FSMContext):
+    """
+    FSM context of one update. State and data are read together on first
+    access, changes are kept in memory and written by flush() after the
+    handler, so an update costs at most one read and one write
+    """
+
+    def __init__(self, storage: BaseStorage, key: StorageKey) -> None:
+        super().__init__(storage=storage, key=key)
+        self._loaded = False
+        self._state: str | None = None
+        self._data: dict[str, Any] = {}
+        self._state_changed = False
+        self._data_changed = False
+
+    async def _load(self) -> None:
+        if self._loaded:
+            return
+        state, data = await get_record(self.storage, self.key)
+        # values set before the first read win
+        if not self._state_changed:
+            self._state = state
+        if not self._data_changed:
+            self._data = data
+        self._loaded = True
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_changed = True
+
+    async def get_state(self) -> str | None:
+        if not self._state_changed:
+            await self._load()
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self._data = dict(data)
+        self._data_changed = True
+
+    async def get_data(self) -> dict[str, Any]:
+        if not self._data_changed:
+            await self._load()
+        return dict(self._data)
+
+    async def get_value(self, key: str, default: Any | None = None) -> Any:
+        return (await self.get_data()).get(key, default)
+
+    async def update_data(self, data: Mapping[str, Any] | None = None,
+                          **kwargs: Any) -> dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        self._data = {**await self.get_data(), **kwargs}
+        self._data_changed = True
+        return dict(self._data)
+
+    async def flush(self) -> None:
+        """Write changes made since the last flush"""
+        if not (self._state_changed or self._data_changed):
+            return
+        await set_record(self.storage, self.key, self._state, self._data,
+                         state_changed=self._state_changed,
+                         data_changed=self._data_changed)
+        self._state_changed = self._data_changed = False
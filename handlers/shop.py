@@ -1,30 +1,46 @@
-import os
+import asyncio
 import textwrap
-from aiogram import Router
+from aiogram import Router, F
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, ExceptionTypeFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.types import (Message, CallbackQuery, FSInputFile,
+                           ErrorEvent, InlineKeyboardMarkup, InlineQuery,
+                           InlineQueryResultArticle, InputMediaPhoto,
+                           InputTextMessageContent)
 from pydantic import validate_email
 from pydantic_core import PydanticCustomError
 
 from callbackdata_factory.callbacks import (ProductCallback, BackCallback,
                                             AddToShoppingCartCallback,
+                                            ChangeQuantityCallback,
+                                            GalleryCallback,
+                                            PageGalleryCallback,
                                             MyShoppingCartCallback,
                                             RemoveProductCartCallback,
                                             PayCallback,
                                             PaginatorCallback)
-from keyboards.inline_keyboards import (create_catalog_inlines,
+from keyboards.inline_keyboards import (CatalogKeyboards,
                                         return_back_and_cart_button,
                                         remove_product_cart,
+                                        search_results_inlines,
                                         working_with_cart)
 from keyboards.reply_keyboards import get_check_email_keyboards
+from cart_queue import CartWriteQueue
+from cart_store import CartStore
+from catalog_search import CatalogIndex
 from commands.command_menu import set_commands
-from strapi import Strapi
+from image_cache import ImageCache
+from photo_cache import PhotoFileIdCache
+from strapi import Strapi, StrapiUnavailable
+from strapi_model import ProductAttributes, ProductImageSize
 
 shop = Router(name=__name__)
 
+# max pictures in one telegram media group
+MEDIA_GROUP_SIZE = 10
+
 
 class UserShopping(StatesGroup):
     start = State()
@@ -35,81 +51,226 @@ class UserShopping(StatesGroup):
     confirm_email = State()
 
 
+def product_pictures(attributes: ProductAttributes) -> list[ProductImageSize]:
+    """formats.small of product pictures, empty when it has none"""
+    if attributes.picture is None or not attributes.picture.data:
+        return []
+    return [picture.attributes.formats.small
+            for picture in attributes.picture.data]
+
+
 @shop.message(CommandStart())
 async def start_shopping(message: Message, state: FSMContext,
-                         strapi: Strapi) -> None:
+                         strapi: Strapi,
+                         catalog_keyboards: CatalogKeyboards) -> None:
     async with strapi:
-        products = await strapi.get_product_all()
+        reply_markup = await catalog_keyboards.page(
+            page=1,
+            id_user=message.from_user.id)
 
         await set_commands(message.bot)
         await state.set_state(UserShopping.start)
         await message.answer(
-            'Пожалуйста выберите:', reply_markup=await create_catalog_inlines(
-                id_user=message.from_user.id,
-                end_page=int(os.getenv('PAGINATION')),
-                products=products,
-            ))
+            'Пожалуйста выберите:', reply_markup=reply_markup)
 
 
 @shop.callback_query(ProductCallback.filter())
 async def detail_product(call: CallbackQuery,
                          callback_data: ProductCallback,
                          state: FSMContext,
-                         strapi: Strapi):
+                         strapi: Strapi,
+                         photo_cache: PhotoFileIdCache,
+                         image_cache: ImageCache):
     async with strapi:
         product = await strapi.get_product_by_id(callback_data.id)
+        attributes = product.data.attributes
+        pictures = product_pictures(attributes)
 
-        await call.message.answer_photo(BufferedInputFile(
-            await strapi.get_photo_bytes(callback_data.id),
-            filename='{}.jpeg'.format(product.data.attributes.title)),
-            caption=textwrap.dedent('''{title}  - {price}руб.
+        caption = textwrap.dedent('''{title}  - {price}руб.
     {description}
     '''.format(
-                title=product.data.attributes.title,
-                price=product.data.attributes.price,
-                description=product.data.attributes.description)),
-            reply_markup=return_back_and_cart_button(
-                callback_data.id,
-                call.from_user.id))
+            title=attributes.title,
+            price=attributes.price,
+            description=attributes.description))
+        reply_markup = return_back_and_cart_button(
+            callback_data.id,
+            call.from_user.id,
+            pictures=len(pictures))
+
+        if not pictures:
+            await call.message.answer(caption, reply_markup=reply_markup)
+            await state.set_state(UserShopping.handle_menu)
+            return
+
+        picture = pictures[0]
+        file_id = await photo_cache.get(picture.hash)
+        message = None
+        if file_id is not None:
+            try:
+                message = await call.message.answer_photo(
+                    file_id,
+                    caption=caption,
+                    reply_markup=reply_markup)
+            except TelegramBadRequest:
+                # file_id is not accepted any more, upload it again
+                await photo_cache.delete(picture.hash)
+        if message is None:
+            message = await call.message.answer_photo(
+                FSInputFile(await image_cache.get(picture),
+                            filename='{}.jpeg'.format(attributes.title)),
+                caption=caption,
+                reply_markup=reply_markup)
+            await photo_cache.set(picture.hash, message.photo[-1].file_id)
         await state.set_state(UserShopping.handle_menu)
 
 
-@shop.callback_query(AddToShoppingCartCallback.filter())
-async def add_shopping_cart(call: CallbackQuery,
-                            callback_data: AddToShoppingCartCallback,
-                            strapi: Strapi):
+async def send_album(message: Message,
+                     pictures: list[ProductImageSize],
+                     captions: list[str | None],
+                     photo_cache: PhotoFileIdCache,
+                     image_cache: ImageCache) -> None:
+    """
+    Send pictures as media groups of up to 10, one Bot API call per
+     group. Pictures not uploaded before are downloaded concurrently,
+     a group telegram refuses for a stale file_id is uploaded again
+    :param message: message the album answers
+    :param pictures: formats.small of pictures
+    :param captions: caption of every picture or None
+    """
+    file_ids = await photo_cache.get_many(
+        [picture.hash for picture in pictures])
+    uploads = [picture for picture, file_id in zip(pictures, file_ids)
+               if file_id is None]
+    paths = dict(zip((picture.hash for picture in uploads),
+                     await image_cache.get_many(uploads)))
+
+    for start in range(0, len(pictures), MEDIA_GROUP_SIZE):
+        group = pictures[start:start + MEDIA_GROUP_SIZE]
+        group_captions = captions[start:start + MEDIA_GROUP_SIZE]
+        group_ids = file_ids[start:start + MEDIA_GROUP_SIZE]
+        try:
+            sent = await send_media(message, [
+                InputMediaPhoto(
+                    media=file_id or FSInputFile(paths[picture.hash]),
+                    caption=caption)
+                for picture, file_id, caption in zip(group, group_ids,
+                                                     group_captions)])
+        except TelegramBadRequest:
+            cached = [picture for picture, file_id in zip(group, group_ids)
+                      if file_id is not None]
+            if not cached:
+                raise
+            await photo_cache.delete(*(picture.hash for picture in cached))
+            paths.update(zip((picture.hash for picture in cached),
+                             await image_cache.get_many(cached)))
+            group_ids = [None] * len(group)
+            sent = await send_media(message, [
+                InputMediaPhoto(media=FSInputFile(paths[picture.hash]),
+                                caption=caption)
+                for picture, caption in zip(group, group_captions)])
+        for picture, file_id, album_message in zip(group, group_ids, sent):
+            if file_id is None and album_message.photo:
+                await photo_cache.set(picture.hash,
+                                      album_message.photo[-1].file_id)
+
+
+async def send_media(message: Message,
+                     media: list[InputMediaPhoto]) -> list[Message]:
+    """Send media group, a single picture as photo"""
+    if len(media) == 1:
+        # media group takes two pictures at least
+        return [await message.answer_photo(media[0].media,
+                                           caption=media[0].caption)]
+    return await message.answer_media_group(media)
+
+
+@shop.callback_query(GalleryCallback.filter())
+async def gallery_product(call: CallbackQuery,
+                          callback_data: GalleryCallback,
+                          strapi: Strapi,
+                          photo_cache: PhotoFileIdCache,
+                          image_cache: ImageCache):
     async with strapi:
-        await strapi.create_user_cart(
-            product_id=callback_data.id_product,
-            user_id=call.from_user.id,
-            data_model={
-                'data': {
-                    'id_tg': call.from_user.id,
-                }
-            },
-            data_relation={'data': {
-                'product': callback_data.id_product,
-                'quantity': 1,
-            }
-            })
-        await call.answer('Добавлен  в корзину')
-
-        await call.message.edit_reply_markup(
-            reply_markup=remove_product_cart(call.from_user.id)
-        )
+        product = await strapi.get_product_by_id(callback_data.id_product)
+        attributes = product.data.attributes
+        pictures = product_pictures(attributes)
+        if not pictures:
+            await call.answer('У товара нет фото')
+            return
+        captions = ['{title}  - {price}руб.'.format(
+            title=attributes.title,
+            price=attributes.price)] + [None] * (len(pictures) - 1)
+
+        await send_album(call.message, pictures, captions,
+                         photo_cache, image_cache)
+    await call.answer()
+
+
+@shop.callback_query(PageGalleryCallback.filter())
+async def gallery_page(call: CallbackQuery,
+                       callback_data: PageGalleryCallback,
+                       strapi: Strapi,
+                       photo_cache: PhotoFileIdCache,
+                       image_cache: ImageCache,
+                       catalog_keyboards: CatalogKeyboards):
+    async with strapi:
+        catalog_page = await strapi.get_product_page(
+            page=callback_data.page,
+            page_size=catalog_keyboards.page_size)
+        # served from catalog cache, strapi calls are capped by the client
+        products = await asyncio.gather(*(
+            strapi.get_product_by_id(row.id) for row in catalog_page.rows))
+
+        pictures, captions = [], []
+        for product in products:
+            attributes = product.data.attributes
+            first = product_pictures(attributes)[:1]
+            if not first:
+                continue
+            pictures.extend(first)
+            captions.append('{title}  - {price}руб.'.format(
+                title=attributes.title,
+                price=attributes.price))
+
+        await send_album(call.message, pictures, captions,
+                         photo_cache, image_cache)
+    await call.answer()
 
 
-@shop.callback_query(MyShoppingCartCallback.filter())
-async def get_my_shopping_cart(call: CallbackQuery,
-                               callback_data: MyShoppingCartCallback,
-                               state: FSMContext,
-                               strapi: Strapi):
+@shop.callback_query(AddToShoppingCartCallback.filter())
+async def add_shopping_cart(call: CallbackQuery,
+                            callback_data: AddToShoppingCartCallback,
+                            cart_queue: CartWriteQueue):
+    await cart_queue.change_quantity(call.from_user.id,
+                                     callback_data.id_product)
+    await call.answer('Добавлен  в корзину')
+
+    await call.message.edit_reply_markup(
+        reply_markup=remove_product_cart(call.from_user.id)
+    )
+
+
+async def render_cart(id_user: int,
+                      state: FSMContext,
+                      strapi: Strapi,
+                      cart_store: CartStore,
+                      cart_queue: CartWriteQueue
+                      ) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    Text and keyboard of user cart after pending changes are written,
+     the cart is shown as it is when they are not written in time
+    """
+    await cart_queue.wait(id_user)
+    all_products = await cart_store.get(id_user)
     async with strapi:
-        all_products = await strapi.get_cart_by_filter(
-            filter=str(callback_data.id_user),
-            filter_field='id_tg')
+        if all_products is None:
+            all_products = await strapi.get_cart_by_filter(
+                filter=str(id_user),
+                filter_field='id_tg')
+            await cart_store.set(id_user, all_products)
         products = []
         total_price = []
+        id_cart = None
         for product_list in all_products.data:
             for product in product_list.attributes.quantity_products.data:
                 products.append(
@@ -124,7 +285,7 @@ async def get_my_shopping_cart(call: CallbackQuery,
                     product.attributes.quantity *
                     product.attributes.product.data.attributes.price
                 )
-            await state.update_data(id_cart=product_list.id)
+            id_cart = product_list.id
         answer = '''
         Товары в корзине:
     '''
@@ -141,12 +302,47 @@ async def get_my_shopping_cart(call: CallbackQuery,
         answer += textwrap.dedent('Итог: {total_price}'.format(
             total_price=total_price)
         )
-        await state.update_data(total_price=total_price)
-        await call.message.answer(text=textwrap.dedent(answer),
-                                  reply_markup=working_with_cart(all_products)
-                                  )
+        cart_data = {'total_price': total_price}
+        if id_cart is not None:
+            cart_data['id_cart'] = id_cart
+        await state.update_data(cart_data)
+        return textwrap.dedent(answer), working_with_cart(all_products)
+
+
+@shop.callback_query(MyShoppingCartCallback.filter())
+async def get_my_shopping_cart(call: CallbackQuery,
+                               callback_data: MyShoppingCartCallback,
+                               state: FSMContext,
+                               strapi: Strapi,
+                               cart_store: CartStore,
+                               cart_queue: CartWriteQueue):
+    text, reply_markup = await render_cart(callback_data.id_user, state,
+                                           strapi, cart_store, cart_queue)
+    await call.message.answer(text=text, reply_markup=reply_markup)
+
+    await state.set_state(UserShopping.handle_cart)
+
 
-        await state.set_state(UserShopping.handle_cart)
+# callback data comes from the client, keyboard buttons change by one
+@shop.callback_query(ChangeQuantityCallback.filter(F.delta.in_({-1, 1})))
+async def change_quantity_cart(call: CallbackQuery,
+                               callback_data: ChangeQuantityCallback,
+                               state: FSMContext,
+                               strapi: Strapi,
+                               cart_store: CartStore,
+                               cart_queue: CartWriteQueue):
+    await cart_queue.change_quantity(call.from_user.id,
+                                     callback_data.id_product,
+                                     callback_data.delta)
+    await call.answer()
+
+    text, reply_markup = await render_cart(call.from_user.id, state,
+                                           strapi, cart_store, cart_queue)
+    try:
+        await call.message.edit_text(text=text, reply_markup=reply_markup)
+    except TelegramBadRequest:
+        # message is not modified, a later tap rendered it already
+        pass
 
 
 @shop.callback_query(RemoveProductCartCallback.filter())
@@ -154,22 +350,23 @@ async def remove_product_shopping_cart(
         call: CallbackQuery,
         callback_data: RemoveProductCartCallback,
         state: FSMContext,
-        strapi: Strapi):
-
-    async with strapi:
-
-        await strapi.deleted_product(
-            callback_data.remove_id_quantity_product
-        )
+        strapi: Strapi,
+        cart_store: CartStore,
+        cart_queue: CartWriteQueue):
 
-        await call.answer('Продукт убран из корзины')
-        await get_my_shopping_cart(call,
-                                   MyShoppingCartCallback(
-                                       id_user=call.from_user.id
-                                   ),
-                                   strapi=strapi,
-                                   state=state)
+    await cart_queue.remove_product(
+        call.from_user.id,
+        callback_data.remove_id_quantity_product)
 
+    await call.answer('Продукт убран из корзины')
+    await get_my_shopping_cart(call,
+                               MyShoppingCartCallback(
+                                   id_user=call.from_user.id
+                               ),
+                               strapi=strapi,
+                               state=state,
+                               cart_store=cart_store,
+                               cart_queue=cart_queue)
 
 
 @shop.callback_query(PayCallback.filter())
@@ -183,6 +380,7 @@ async def survey_user(call: CallbackQuery,
 async def get_email(message: Message, state: FSMContext):
     try:
         validate_email(message.text)
+        await state.update_data(email=message.text)
         await state.set_state(UserShopping.confirm_email)
         await message.answer(textwrap.dedent(
             '''Проверьте правильность почты:
@@ -199,19 +397,51 @@ async def get_email(message: Message, state: FSMContext):
 
 @shop.message(UserShopping.confirm_email)
 async def check_email_finish_step(message: Message, state: FSMContext,
-                                  strapi: Strapi):
+                                  strapi: Strapi, cart_store: CartStore,
+                                  cart_queue: CartWriteQueue,
+                                  catalog_keyboards: CatalogKeyboards):
     data_order = await state.get_data()
 
     if message.text == 'Да':
-        async with strapi:
-            await strapi.unpublished_cart(data_order.get('id_cart'))
-        await state.clear()
-        await state.set_state(UserShopping.start)
+        if not await cart_queue.wait(message.from_user.id):
+            # total price may not match the cart yet
+            await message.answer(
+                'Корзина еще обновляется, попробуйте через минуту')
+            return
+        id_cart = data_order.get('id_cart')
+        if id_cart is None or not data_order.get('total_price'):
+            await message.answer('Ваша корзина пуста')
+            await state.set_state(UserShopping.start)
+            return
+        # same for a double tap, so only one order is placed
+        idempotency_key = '{id_tg}:{id_cart}'.format(
+            id_tg=message.from_user.id, id_cart=id_cart)
+        if not await cart_store.claim_checkout(idempotency_key):
+            await message.answer('Заказ уже оформляется')
+            return
+        placed = False
+        try:
+            async with strapi:
+                await strapi.checkout(
+                    id_cart=id_cart,
+                    user_id=message.from_user.id,
+                    email=data_order.get('email'),
+                    total_price=data_order.get('total_price'),
+                    idempotency_key=idempotency_key)
+            placed = True
+        finally:
+            # failed or cancelled checkout may be repeated right away,
+            # claim of a placed one expires by itself
+            if not placed:
+                await cart_store.release_checkout(idempotency_key)
+        await cart_store.drop(message.from_user.id)
+        # start_shopping sets the state
+        await state.set_data({})
 
         await message.answer('''
 Спасибо за заказ!
 Ожидайте подтверждения по почте!''')
-        await start_shopping(message, state, strapi)
+        await start_shopping(message, state, strapi, catalog_keyboards)
     else:
         await message.answer('Введите вашу почту')
         await state.set_state(UserShopping.waiting_email)
@@ -220,16 +450,13 @@ async def check_email_finish_step(message: Message, state: FSMContext,
 @shop.callback_query(PaginatorCallback.filter())
 async def pagination_page(call: CallbackQuery,
                           callback_data: PaginatorCallback,
-                          strapi: Strapi):
-    start = callback_data.start_page
-    end = callback_data.end_page
+                          strapi: Strapi,
+                          catalog_keyboards: CatalogKeyboards):
     current_page = callback_data.current_page
     last_page = callback_data.last_page
 
     if callback_data.next:
-        if current_page != last_page:
-            start = end
-            end += int(os.getenv('PAGINATION'))
+        if current_page < last_page:
             current_page += 1
             await call.answer()
         else:
@@ -237,9 +464,7 @@ async def pagination_page(call: CallbackQuery,
             await call.answer('Это последняя страница')
 
     if callback_data.back:
-        if current_page != 1:
-            end = start
-            start -= int(os.getenv('PAGINATION'))
+        if current_page > 1:
             current_page -= 1
             await call.answer()
         else:
@@ -248,32 +473,65 @@ async def pagination_page(call: CallbackQuery,
 
     try:
         async with strapi:
-            products = await strapi.get_product_all()
             await call.message.edit_reply_markup(
-                reply_markup=await create_catalog_inlines(
-                    id_user=call.from_user.id,
-                    current_page=current_page,
-                    start_page=start,
-                    end_page=end,
-                    products=products))
+                reply_markup=await catalog_keyboards.page(
+                    page=current_page,
+                    id_user=call.from_user.id))
     except TelegramBadRequest:
         pass
 
 
 @shop.callback_query(BackCallback.filter())
 async def back_menu(call: CallbackQuery, state: FSMContext,
-                    strapi: Strapi):
+                    strapi: Strapi, catalog_keyboards: CatalogKeyboards):
     async with strapi:
-        products = await strapi.get_product_all()
-
         await call.message.edit_reply_markup(
-            reply_markup=await create_catalog_inlines(
-                id_user=call.from_user.id,
-                current_page=1,
-                start_page=0,
-                end_page=int(os.getenv('PAGINATION')),
-                products=products
+            reply_markup=await catalog_keyboards.page(
+                page=1,
+                id_user=call.from_user.id
             )
         )
 
         await state.set_state(UserShopping.handle_description)
+
+
+@shop.message(F.text, ~F.text.startswith('/'))
+async def search_products(message: Message, catalog_index: CatalogIndex):
+    results = catalog_index.search(message.text, limit=10)
+    if not results:
+        await message.answer('Ничего не найдено, попробуйте другой запрос')
+        return
+    await message.answer(
+        'Найдено:',
+        reply_markup=search_results_inlines(results, message.from_user.id))
+
+
+@shop.inline_query()
+async def inline_search_products(inline_query: InlineQuery,
+                                 catalog_index: CatalogIndex):
+    results = catalog_index.search(inline_query.query)
+    await inline_query.answer([
+        InlineQueryResultArticle(
+            id=str(product.id),
+            title=product.title,
+            description='{price}руб. {description}'.format(
+                price=product.price,
+                description=product.description),
+            input_message_content=InputTextMessageContent(
+                message_text=textwrap.dedent('''{title}  - {price}руб.
+    {description}
+    '''.format(
+                    title=product.title,
+                    price=product.price,
+                    description=product.description))))
+        for product in results
+    ], cache_time=60)
+
+
+@shop.error(ExceptionTypeFilter(StrapiUnavailable))
+async def strapi_unavailable(event: ErrorEvent):
+    text = 'Магазин временно недоступен, попробуйте позже'
+    if event.update.callback_query is not None:
+        await event.update.callback_query.answer(text, show_alert=True)
+    elif event.update.message is not None:
+        await event.update.message.answer(text)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from strapi import Strapi, SingleFlight
+from strapi_model import ProductImageSize
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """
+    Product pictures downloaded once to local disk. A file is named by
+    ProductImageSize.hash, which changes with the picture, so it never
+    gets stale. Pictures are streamed to disk and uploaded to telegram
+    from file, no picture is held in memory.
+    """
+
+    def __init__(self, strapi: Strapi, directory: str = 'cache/images',
+                 concurrency: int = 4,
+                 prewarm_concurrency: int = 4,
+                 page_size: int = 100) -> None:
+        """
+        :param strapi: client downloading pictures
+        :param directory: directory of cached files, created on startup
+        :param concurrency: pictures downloaded at once by get_many
+        :param prewarm_concurrency: pictures downloaded at once by
+         prewarm on startup, 0 - no prewarm
+        :param page_size: count products in one request of prewarm
+        """
+        self._strapi = strapi
+        self._directory = directory
+        self._concurrency = concurrency
+        self._prewarm_concurrency = prewarm_concurrency
+        self._page_size = page_size
+        self._flights = SingleFlight()
+        self._prewarm: asyncio.Task | None = None
+
+    def path(self, picture: ProductImageSize) -> str:
+        """File of picture, it may not be downloaded yet"""
+        extension = (os.path.splitext(picture.name)[1]
+                     or os.path.splitext(picture.url)[1])
+        return os.path.join(self._directory,
+                            os.path.basename(picture.hash) + extension)
+
+    async def get(self, picture: ProductImageSize) -> str:
+        """
+        Get file of picture, download it when it is not cached,
+         concurrent calls for one picture share the download
+        :param picture: formats.small of product picture
+        :return: path of file
+        """
+        path = self.path(picture)
+        if not os.path.exists(path):
+            await self._flights.do(
+                picture.hash, lambda: self._download(picture, path))
+        return path
+
+    async def get_many(self, pictures: list[ProductImageSize],
+                       concurrency: int | None = None,
+                       return_exceptions: bool = False) -> list:
+        """
+        Get files of pictures downloading the missing ones concurrently
+        :param pictures: formats.small of product pictures
+        :param concurrency: downloads at once, default set in constructor
+        :param return_exceptions: failed picture gives its exception
+         instead of failing the call
+        :return: paths in order of pictures
+        """
+        semaphore = asyncio.Semaphore(concurrency or self._concurrency)
+
+        async def get(picture: ProductImageSize) -> str:
+            async with semaphore:
+                return await self.get(picture)
+
+        return await asyncio.gather(*(get(picture) for picture in pictures),
+                                    return_exceptions=return_exceptions)
+
+    async def _download(self, picture: ProductImageSize, path: str) -> None:
+        # readers never see a partly written file
+        part = '{path}.{token}.part'.format(path=path,
+                                            token=uuid.uuid4().hex)
+        try:
+            async with self._strapi:
+                await self._strapi.download_photo(picture.url, part)
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+    async def start(self) -> None:
+        """Create directory and download catalog pictures in background"""
+        os.makedirs(self._directory, exist_ok=True)
+        if self._prewarm_concurrency > 0:
+            self._prewarm = asyncio.create_task(self._prewarm_catalog())
+            self._prewarm.add_done_callback(self._prewarm_done)
+
+    async def ready(self) -> None:
+        """Wait until prewarm started on startup is over"""
+        if self._prewarm is not None:
+            await asyncio.wait([self._prewarm])
+
+    async def stop(self) -> None:
+        if self._prewarm is not None:
+            self._prewarm.cancel()
+
+    async def _prewarm_catalog(self) -> None:
+        """Download missing pictures of catalog, remove pictures not in it"""
+        started = time.time()
+        async with self._strapi:
+            pictures = await self._strapi.get_product_pictures(
+                page_size=self._page_size)
+        paths = await self.get_many(pictures,
+                                    concurrency=self._prewarm_concurrency,
+                                    return_exceptions=True)
+        for picture, path in zip(pictures, paths):
+            if isinstance(path, Exception):
+                logger.warning('Picture %s not cached: %r', picture.url, path)
+        self._prune({self.path(picture) for picture in pictures}, started)
+        logger.info('Image cache warmed, %s pictures', len(pictures))
+
+    def _prune(self, paths: set[str], before: float) -> None:
+        """
+        Remove replaced pictures
+        :param paths: files of pictures in catalog
+        :param before: files modified later may belong to products
+         created during prewarm, they are kept
+        """
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if (entry.is_file() and entry.path not in paths
+                        and not entry.name.endswith('.part')
+                        and entry.stat().st_mtime < before):
+                    os.remove(entry.path)
+
+    @staticmethod
+    def _prewarm_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Image cache prewarm failed: %r', task.exception())
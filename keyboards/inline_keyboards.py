@@ -1,29 +1,127 @@
-import os
-from aiogram.types import InlineKeyboardMarkup
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from callbackdata_factory.callbacks import (ProductCallback, BackCallback,
                                             AddToShoppingCartCallback,
+                                            GalleryCallback,
+                                            PageGalleryCallback,
+                                            ChangeQuantityCallback,
                                             RemoveProductCartCallback,
                                             MyShoppingCartCallback,
                                             PayCallback,
                                             PaginatorCallback)
-from strapi_model import ShoppingCartStrapiModelList, ProductStrapiModelList
-
-
-async def create_catalog_inlines(
-        products: ProductStrapiModelList,
-        id_user: int,
-        end_page: int,
-        current_page: int = 1,
-        start_page: int = 0) -> InlineKeyboardMarkup:
+from catalog_search import SearchResult
+from strapi import Strapi
+from strapi_model import ShoppingCartStrapiModelList, CatalogPage
+
+
+class CatalogKeyboards:
+    """
+    Catalog page keyboards built once per catalog version and page,
+     only "My cart" button is filled per user
+    """
+
+    def __init__(self, strapi: Strapi, page_size: int) -> None:
+        """
+        :param strapi: client serving cached catalog pages
+        :param page_size: count products on page
+        """
+        self._strapi = strapi
+        self.page_size = page_size
+        self._version = None
+        # page -> (CatalogPage rows were built from, product rows,
+        #  pagination row)
+        self._pages: dict[int, tuple[CatalogPage,
+                                     list[list[InlineKeyboardButton]],
+                                     list[InlineKeyboardButton]]] = {}
+
+    async def page(self, page: int, id_user: int) -> InlineKeyboardMarkup:
+        """
+        Keyboard of catalog page for user
+        :param page: number of page starting from 1
+        :param id_user: telegram id of user opening the page
+        """
+        products = await self._strapi.get_product_page(
+            page=page, page_size=self.page_size)
+        if self._version != self._strapi.catalog_version:
+            self._pages.clear()
+            self._version = self._strapi.catalog_version
+
+        entry = self._pages.get(page)
+        # page refreshed in background comes as a new CatalogPage
+        if entry is None or entry[0] is not products:
+            entry = self._pages[page] = (products,
+                                         *self._build_rows(products))
+        _, product_rows, pagination_row = entry
+
+        return InlineKeyboardMarkup(inline_keyboard=[
+            *product_rows,
+            [InlineKeyboardButton(
+                text='Моя корзина 🛍️',
+                callback_data=MyShoppingCartCallback(
+                    id_user=id_user
+                ).pack())],
+            pagination_row,
+        ])
+
+    @staticmethod
+    def _build_rows(products: CatalogPage) -> tuple[
+            list[list[InlineKeyboardButton]], list[InlineKeyboardButton]]:
+        """
+        Product buttons one per row with album of the page,
+         pagination row of the page
+        """
+        current_page = products.pagination.page
+        last_page = max(products.pagination.pageCount, 1)
+
+        product_rows = [
+            [InlineKeyboardButton(
+                text='{}'.format(product.title),
+                callback_data=ProductCallback(id=product.id).pack())]
+            for product in products.rows
+        ]
+        if products.rows:
+            product_rows.append([InlineKeyboardButton(
+                text='Фото страницы 🖼',
+                callback_data=PageGalleryCallback(
+                    page=current_page).pack())])
+
+        pagination_row = [
+            InlineKeyboardButton(
+                text='Назад',
+                callback_data=PaginatorCallback(
+                    current_page=current_page,
+                    last_page=last_page,
+                    next=False,
+                    back=True
+                ).pack()),
+            InlineKeyboardButton(
+                text='{current_page}/{last_page}'.format(
+                    current_page=current_page,
+                    last_page=last_page
+                ),
+                callback_data='None'),
+            InlineKeyboardButton(
+                text='Следующая',
+                callback_data=PaginatorCallback(
+                    current_page=current_page,
+                    last_page=last_page,
+                    next=True,
+                    back=False
+                ).pack()),
+        ]
+        return product_rows, pagination_row
+
+
+def search_results_inlines(
+        results: list[SearchResult],
+        id_user: int) -> InlineKeyboardMarkup:
     markup = InlineKeyboardBuilder()
-    pagination_markup = InlineKeyboardBuilder()
 
-    last_page = len(products.data) // int(os.getenv('PAGINATION')) + 1
-
-    for product in products.data[start_page:end_page]:
-        markup.button(text='{}'.format(product.attributes.title),
-                      callback_data=ProductCallback(id=product.id))
+    for product in results:
+        markup.button(text='{title} - {price}руб.'.format(
+            title=product.title,
+            price=product.price),
+            callback_data=ProductCallback(id=product.id))
 
     markup.button(
         text='Моя корзина 🛍️',
@@ -31,49 +129,18 @@ async def create_catalog_inlines(
             id_user=id_user
         )
     )
-
-    pagination_markup.button(
-        text='Назад',
-        callback_data=PaginatorCallback(
-            current_page=current_page,
-            last_page=last_page,
-            start_page=start_page,
-            end_page=end_page,
-            next=False,
-            back=True
-        ))
-
-    pagination_markup.button(text='{current_page}/{last_page}'.format(
-        current_page=current_page,
-        last_page=last_page
-        ),
-        callback_data='None')
-
-    pagination_markup.button(text='Следующая',
-                             callback_data=PaginatorCallback(
-                                 current_page=current_page,
-                                 start_page=start_page,
-                                 last_page=last_page,
-                                 end_page=end_page,
-                                 next=True,
-                                 back=False
-                             )
-                             )
-
+    markup.button(
+        text='В меню',
+        callback_data=BackCallback(back=True)
+    )
     markup.adjust(1, repeat=True)
-
-    pagination_markup.adjust(3)
-
-    buttons = [keyboard for keyboard in pagination_markup.buttons]
-
-    markup.row(*buttons)
-
     return markup.as_markup()
 
 
 def return_back_and_cart_button(
         id_product: int,
-        id_user: int) -> InlineKeyboardMarkup:
+        id_user: int,
+        pictures: int = 1) -> InlineKeyboardMarkup:
     markup = InlineKeyboardBuilder()
 
     markup.button(
@@ -92,6 +159,13 @@ def return_back_and_cart_button(
             id_user=id_user
         )
     )
+    if pictures > 1:
+        markup.button(
+            text='Все фото ({}) 🖼'.format(pictures),
+            callback_data=GalleryCallback(
+                id_product=id_product
+            )
+        )
     markup.adjust(2)
     return markup.as_markup()
 
@@ -115,32 +189,46 @@ def remove_product_cart(id_user: int) -> InlineKeyboardMarkup:
 def working_with_cart(
         cart_products: ShoppingCartStrapiModelList) -> InlineKeyboardMarkup:
     markup = InlineKeyboardBuilder()
-    products_ids = []
+    products = []
     for cart in cart_products.data:
         for product_quantity in cart.attributes.quantity_products.data:
-            products_ids.append(
+            product = product_quantity.attributes.product.data
+            products.append(
                 (
                     product_quantity.id,
-                    product_quantity.attributes.product.data.attributes.title
+                    product.id,
+                    product.attributes.title
                 )
             )
-    for product_quantity_id, title in products_ids:
-        markup.button(
-            text='Убрать {title}'.format(title=title),
-            callback_data=RemoveProductCartCallback(
-                remove_id_quantity_product=product_quantity_id
-            )
+    for product_quantity_id, product_id, title in products:
+        markup.row(
+            InlineKeyboardButton(
+                text='➖',
+                callback_data=ChangeQuantityCallback(
+                    id_product=product_id,
+                    delta=-1
+                ).pack()),
+            InlineKeyboardButton(
+                text='Убрать {title}'.format(title=title),
+                callback_data=RemoveProductCartCallback(
+                    remove_id_quantity_product=product_quantity_id
+                ).pack()),
+            InlineKeyboardButton(
+                text='➕',
+                callback_data=ChangeQuantityCallback(
+                    id_product=product_id,
+                    delta=1
+                ).pack()),
         )
 
-    markup.button(
+    markup.row(InlineKeyboardButton(
         text='Оплатить',
-        callback_data=PayCallback(pay=True)
-    )
+        callback_data=PayCallback(pay=True).pack()
+    ))
 
-    markup.button(
+    markup.row(InlineKeyboardButton(
         text='В меню',
-        callback_data=BackCallback(back=True)
-    )
+        callback_data=BackCallback(back=True).pack()
+    ))
 
-    markup.adjust(1, 1, 1, 2)
     return markup.as_markup()
@@ -3,11 +3,268 @@ import logging
 import os
 import sys
 from aiogram import Dispatcher, Bot
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.webhook.aiohttp_server import (SimpleRequestHandler,
+                                            setup_application)
+from aiohttp import web
 from dotenv import load_dotenv
+from redis.asyncio import Redis
+from cart_queue import CartWriteQueue
+from catalog_search import CatalogIndex
+from cart_store import CartStore
+from fsm_storage import CachedRedisStorage, PipelineRedisStorage
 from handlers.shop import shop
+from image_cache import ImageCache
+from keyboards.inline_keyboards import CatalogKeyboards
+from memory_redis import MemoryRedis
+from metrics import metrics, setup_metrics, LogSink, PrometheusSink
+from middliware.fsm_middleware import BufferedFSMContextMiddleware
+from middliware.metrics_middleware import (MetricsMiddleware,
+                                           TelegramMetricsMiddleware)
 from middliware.strapi_middleware import StrapiCartsMiddleware
-from strapi import Strapi
+from photo_cache import PhotoFileIdCache
+from strapi import Strapi, StrapiBackend
+from webhooks.strapi_webhook import setup_strapi_webhook, WebAppRunner
+from workers import WorkerPool
+
+
+def configure_metrics() -> None:
+    """Instrumentation is off unless METRICS_ENABLED is set"""
+    sinks = [PrometheusSink()]
+    if os.getenv('METRICS_LOG'):
+        sinks.append(LogSink())
+    metrics.configure(enabled=bool(os.getenv('METRICS_ENABLED')),
+                      trace=bool(os.getenv('TRACE_UPDATES')),
+                      sinks=sinks)
+
+
+def create_bot() -> Bot:
+    bot = Bot(os.getenv('TG_BOT_TOKEN'))
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+
+def create_strapi() -> Strapi:
+    """
+    Strapi client for the process, catalog reads go to STRAPI_REPLICA_URL
+     when it is set
+    """
+    backends = {}
+    if os.getenv('STRAPI_REPLICA_URL'):
+        backends['replica'] = StrapiBackend(
+            api_url=os.getenv('STRAPI_REPLICA_URL'),
+            token=os.getenv('STRAPI_REPLICA_TOKEN',
+                            os.getenv('STRAPI_PRODUCT_TOKEN')))
+    return Strapi(
+        token=os.getenv('STRAPI_PRODUCT_TOKEN'),
+        api_url=os.getenv('API_STRAPI_URL'),
+        backends=backends,
+        pool_limit=int(os.getenv('STRAPI_POOL_LIMIT', 100)),
+        pool_limit_per_host=int(os.getenv('STRAPI_POOL_LIMIT_PER_HOST', 0)),
+        keepalive_timeout=float(os.getenv('STRAPI_KEEPALIVE_TIMEOUT', 30)),
+        timeout=float(os.getenv('STRAPI_TIMEOUT', 10)),
+        connect_timeout=float(os.getenv('STRAPI_CONNECT_TIMEOUT', 3)),
+        catalog_ttl=float(os.getenv('CATALOG_CACHE_TTL', 60)),
+        catalog_stale_ttl=float(os.getenv('CATALOG_CACHE_STALE_TTL', 300)),
+        cart_upsert_path=os.getenv('STRAPI_CART_UPSERT_PATH'),
+        checkout_path=os.getenv('STRAPI_CHECKOUT_PATH'),
+        media_timeout=float(os.getenv('STRAPI_MEDIA_TIMEOUT', 0)) or None,
+        retries=int(os.getenv('STRAPI_RETRIES', 2)),
+        retry_backoff=float(os.getenv('STRAPI_RETRY_BACKOFF', 0.2)),
+        retry_max_backoff=float(os.getenv('STRAPI_RETRY_MAX_BACKOFF', 2)),
+        breaker_failures=int(os.getenv('STRAPI_BREAKER_FAILURES', 5)),
+        breaker_reset_timeout=float(os.getenv('STRAPI_BREAKER_RESET', 30)),
+        max_concurrency=int(os.getenv('STRAPI_MAX_CONCURRENCY', 100)),
+    )
+
+
+def create_storage(redis: Redis | None = None) -> BaseStorage:
+    """
+    FSM storage chosen by FSM_STORAGE: 'redis', 'lru' - redis with hot
+     users cached in process memory, 'memory' - one process without redis
+    :param redis: client of redis storages, default one for REDIS_URL
+    """
+    kind = os.getenv('FSM_STORAGE', 'redis')
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind not in ('redis', 'lru'):
+        raise ValueError('Unknown FSM_STORAGE {}'.format(kind))
+
+    if redis is None:
+        redis = Redis.from_url(os.getenv('REDIS_URL'))
+    ttl = {
+        'state_ttl': int(os.getenv('FSM_STATE_TTL', 0)) or None,
+        'data_ttl': int(os.getenv('FSM_DATA_TTL', 0)) or None,
+    }
+    if kind == 'lru':
+        return CachedRedisStorage(
+            redis,
+            cache_size=int(os.getenv('FSM_CACHE_SIZE', 10000)),
+            cache_ttl=float(os.getenv('FSM_CACHE_TTL', 60)),
+            **ttl)
+    return PipelineRedisStorage(redis, **ttl)
+
+
+def create_dispatcher(storage: BaseStorage, strapi: Strapi,
+                      redis: Redis, prewarm: bool = True) -> Dispatcher:
+    """
+    :param prewarm: download catalog pictures on startup, one process
+     of those sharing IMAGE_CACHE_DIR does it
+    """
+    dp = Dispatcher(storage=storage, disable_fsm=True)
+    # updates of one user are handled one by one, buffered state of
+    # an update is written before the next one reads it
+    dp.fsm = BufferedFSMContextMiddleware(
+        storage=storage,
+        events_isolation=SimpleEventIsolation())
+    dp.update.outer_middleware.register(dp.fsm)
+    dp['photo_cache'] = PhotoFileIdCache(redis)
+    dp['cart_store'] = CartStore(
+        redis,
+        ttl=int(os.getenv('CART_SNAPSHOT_TTL', 600)),
+        checkout_ttl=int(os.getenv('CHECKOUT_CLAIM_TTL', 60)))
+    dp['cart_queue'] = CartWriteQueue(
+        redis, strapi, dp['cart_store'],
+        attempts=int(os.getenv('CART_QUEUE_ATTEMPTS', 3)),
+        wait_timeout=float(os.getenv('CART_QUEUE_WAIT_TIMEOUT', 5)))
+    dp['catalog_keyboards'] = CatalogKeyboards(
+        strapi,
+        page_size=int(os.getenv('PAGINATION')))
+    dp['catalog_index'] = CatalogIndex(strapi)
+    dp['image_cache'] = ImageCache(
+        strapi,
+        directory=os.getenv('IMAGE_CACHE_DIR', 'cache/images'),
+        concurrency=int(os.getenv('IMAGE_FETCH_CONCURRENCY', 4)),
+        prewarm_concurrency=(
+            int(os.getenv('IMAGE_PREWARM_CONCURRENCY', 4)) if prewarm else 0))
+
+    if isinstance(storage, CachedRedisStorage):
+        dp.startup.register(storage.start)
+    dp.startup.register(strapi.start)
+    dp.startup.register(dp['cart_queue'].start)
+    dp.startup.register(dp['catalog_index'].start)
+    dp.startup.register(dp['image_cache'].start)
+    dp.shutdown.register(dp['image_cache'].stop)
+    dp.shutdown.register(dp['catalog_index'].stop)
+    dp.shutdown.register(dp['cart_queue'].stop)
+    dp.shutdown.register(strapi.close)
+    dp.shutdown.register(storage.close)
+
+    dp.include_router(shop)
+    dp.update.outer_middleware.register(MetricsMiddleware())
+    dp.update.middleware.register(StrapiCartsMiddleware(strapi))
+    return dp
+
+
+def serve_metrics(dp: Dispatcher, port: int | None) -> None:
+    """Serve Prometheus endpoint on its own port if it is set"""
+    if metrics.enabled and port:
+        app = web.Application()
+        setup_metrics(app, path=os.getenv('METRICS_PATH', '/metrics'))
+        web_runner = WebAppRunner(
+            app,
+            host=os.getenv('METRICS_HOST', '0.0.0.0'),
+            port=port)
+        dp.startup.register(web_runner.start)
+        dp.shutdown.register(web_runner.stop)
+
+
+def serve_strapi_webhook(dp: Dispatcher, strapi: Strapi | WorkerPool) -> None:
+    """Serve strapi webhook on its own port if it is set"""
+    if os.getenv('STRAPI_WEBHOOK_PORT'):
+        app = web.Application()
+        setup_strapi_webhook(
+            app, strapi,
+            path=os.getenv('STRAPI_WEBHOOK_PATH', '/strapi/webhook'),
+            secret=os.getenv('STRAPI_WEBHOOK_SECRET'))
+        web_runner = WebAppRunner(
+            app,
+            host=os.getenv('STRAPI_WEBHOOK_HOST', '0.0.0.0'),
+            port=int(os.getenv('STRAPI_WEBHOOK_PORT')))
+        dp.startup.register(web_runner.start)
+        dp.shutdown.register(web_runner.stop)
+
+
+def run_polling(dp: Dispatcher, bot: Bot, strapi: Strapi) -> None:
+    """Long polling in one process"""
+    serve_strapi_webhook(dp, strapi)
+    serve_metrics(dp, int(os.getenv('METRICS_PORT', 0)))
+    asyncio.run(dp.start_polling(bot))
+
+
+def run_workers(bot: Bot) -> None:
+    """
+    Long polling in this process, updates are handled by BOT_WORKERS
+     processes sharing redis storage, each builds own dispatcher
+    """
+    pool = WorkerPool(
+        workers=int(os.getenv('BOT_WORKERS', os.cpu_count())))
+
+    async def polling() -> None:
+        supervisor = Dispatcher()
+        serve_strapi_webhook(supervisor, pool)
+        await supervisor.emit_startup()
+        try:
+            await pool.run_polling(
+                bot,
+                allowed_updates=shop.resolve_used_update_types())
+        finally:
+            await supervisor.emit_shutdown()
+
+    asyncio.run(polling())
+
+
+def run_webhook(dp: Dispatcher, bot: Bot, strapi: Strapi) -> None:
+    """
+    Telegram webhook served by aiohttp, updates are handled concurrently,
+     so several replicas can run behind a load balancer
+    """
+    path = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+    secret = os.getenv('WEBHOOK_SECRET')
+    if not secret:
+        # anyone knowing the url could post updates as any user
+        raise ValueError('BOT_MODE=webhook requires WEBHOOK_SECRET')
+
+    async def set_webhook(bot: Bot) -> None:
+        if os.getenv('WEBHOOK_BASE_URL'):
+            await bot.set_webhook(
+                url='{base}{path}'.format(
+                    base=os.getenv('WEBHOOK_BASE_URL').rstrip('/'),
+                    path=path),
+                secret_token=secret,
+                allowed_updates=dp.resolve_used_update_types())
+
+    async def close_bot_session(bot: Bot) -> None:
+        await bot.session.close()
+
+    dp.startup.register(set_webhook)
+    dp.shutdown.register(close_bot_session)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+    ).register(app, path=path)
+    # public endpoint, it is not mounted without a secret
+    if os.getenv('STRAPI_WEBHOOK_SECRET'):
+        setup_strapi_webhook(
+            app, strapi,
+            path=os.getenv('STRAPI_WEBHOOK_PATH', '/strapi/webhook'),
+            secret=os.getenv('STRAPI_WEBHOOK_SECRET'))
+    else:
+        logging.warning('STRAPI_WEBHOOK_SECRET is not set, '
+                        'strapi webhook is disabled')
+    if metrics.enabled:
+        setup_metrics(app, path=os.getenv('METRICS_PATH', '/metrics'))
+    setup_application(app, dp, bot=bot)
+
+    web.run_app(app,
+                host=os.getenv('WEBAPP_HOST', '0.0.0.0'),
+                port=int(os.getenv('WEBAPP_PORT', 8080)))
+
 
 if __name__ == "__main__":
     load_dotenv('.env')
@@ -18,11 +275,25 @@ if __name__ == "__main__":
         stream=sys.stdout
     )
 
-    storage = RedisStorage.from_url(os.getenv('REDIS_URL'))
-    bot = Bot(os.getenv('TG_BOT_TOKEN'))
-    dp = Dispatcher(storage=storage)
-
-    dp.include_router(shop)
-    dp.update.middleware.register(StrapiCartsMiddleware())
+    mode = os.getenv('BOT_MODE', 'polling')
+    if mode in ('webhook', 'workers') and os.getenv('FSM_STORAGE') == 'memory':
+        # every process and replica would see own states
+        raise ValueError(
+            'FSM_STORAGE=memory requires BOT_MODE=polling, got {}'.format(mode))
 
-    asyncio.run(dp.start_polling(bot))
+    configure_metrics()
+    bot = create_bot()
+    if mode == 'workers':
+        # handlers run in worker processes, polling needs only the bot
+        run_workers(bot)
+    else:
+        storage = create_storage()
+        strapi = create_strapi()
+        dp = create_dispatcher(
+            storage, strapi,
+            storage.redis if isinstance(storage, RedisStorage)
+            else MemoryRedis())
+        if mode == 'webhook':
+            run_webhook(dp, bot, strapi)
+        else:
+            run_polling(dp, bot, strapi)
@@ -0,0 +1,207 @@
+import asyncio
+import functools
+import time
+from typing import AbstractSet
+from cart_queue import RELEASE_LOCK, RENEW_LOCK
+
+
+def command(method):
+    """Count call as one round trip to redis"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        self.round_trips += 1
+        return await method(self, *args, **kwargs)
+    return wrapper
+
+
+class MemoryRedis:
+    """
+    In-process stand-in for the redis commands used by the bot, one
+     process with FSM_STORAGE=memory and the benchmark run on it
+    """
+
+    def __init__(self) -> None:
+        self._values: dict[str, tuple[bytes, float | None]] = {}
+        self._lists: dict[str, list[bytes]] = {}
+        self._sets: dict[str, set[bytes]] = {}
+        self._subscribers: dict[str, list[asyncio.Queue]] = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction: bool = True) -> 'MemoryPipeline':
+        return MemoryPipeline(self)
+
+    def pubsub(self) -> 'MemoryPubSub':
+        return MemoryPubSub(self)
+
+    @command
+    async def publish(self, channel: str, message) -> int:
+        queues = self._subscribers.get(channel, [])
+        for queue in queues:
+            queue.put_nowait({'type': 'message', 'channel': channel.encode(),
+                              'data': _encode(message)})
+        return len(queues)
+
+    async def aclose(self, close_connection_pool: bool = True) -> None:
+        pass
+
+    def _get(self, name: str) -> bytes | None:
+        value, expire_at = self._values.get(name, (None, None))
+        if expire_at is not None and expire_at < time.monotonic():
+            del self._values[name]
+            return None
+        return value
+
+    @command
+    async def eval(self, script: str, numkeys: int, *keys_and_args):
+        """Scripts used by the bot run as their python equivalents"""
+        name, token = keys_and_args[0], _encode(keys_and_args[1])
+        if self._get(name) != token:
+            return 0
+        if script == RENEW_LOCK:
+            self._values[name] = (
+                token, time.monotonic() + int(keys_and_args[2]))
+            return 1
+        if script == RELEASE_LOCK:
+            del self._values[name]
+            return 1
+        raise NotImplementedError('Unknown script')
+
+    @command
+    async def get(self, name: str) -> bytes | None:
+        return self._get(name)
+
+    @command
+    async def getex(self, name: str, ex: int | None = None) -> bytes | None:
+        value = self._get(name)
+        if value is not None and ex is not None:
+            self._values[name] = (value, time.monotonic() + ex)
+        return value
+
+    @command
+    async def mget(self, names: list[str]) -> list[bytes | None]:
+        return [self._get(name) for name in names]
+
+    @command
+    async def set(self, name: str, value, ex: int | None = None,
+                  nx: bool = False) -> bool | None:
+        if nx and self._get(name) is not None:
+            return None
+        self._values[name] = (
+            _encode(value), time.monotonic() + ex if ex is not None else None)
+        return True
+
+    @command
+    async def delete(self, *names: str) -> int:
+        return sum(self._values.pop(name, None) is not None
+                   for name in names)
+
+    @command
+    async def rpush(self, name: str, *values) -> int:
+        items = self._lists.setdefault(name, [])
+        items.extend(_encode(value) for value in values)
+        return len(items)
+
+    @command
+    async def lpush(self, name: str, *values) -> int:
+        items = self._lists.setdefault(name, [])
+        items[:0] = [_encode(value) for value in reversed(values)]
+        return len(items)
+
+    @command
+    async def lrange(self, name: str, start: int, end: int) -> list[bytes]:
+        items = self._lists.get(name, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    @command
+    async def ltrim(self, name: str, start: int, end: int) -> bool:
+        items = self._lists.get(name, [])
+        items[:] = items[start:] if end == -1 else items[start:end + 1]
+        if not items:
+            self._lists.pop(name, None)
+        return True
+
+    @command
+    async def llen(self, name: str) -> int:
+        return len(self._lists.get(name, []))
+
+    @command
+    async def sadd(self, name: str, *values) -> int:
+        members = self._sets.setdefault(name, set())
+        added = {_encode(value) for value in values} - members
+        members.update(added)
+        return len(added)
+
+    @command
+    async def srem(self, name: str, *values) -> int:
+        members = self._sets.get(name, set())
+        removed = {_encode(value) for value in values} & members
+        members.difference_update(removed)
+        return len(removed)
+
+    @command
+    async def smembers(self, name: str) -> AbstractSet[bytes]:
+        return set(self._sets.get(name, set()))
+
+
+class MemoryPipeline:
+    """Commands queued and run in one round trip"""
+
+    def __init__(self, redis: MemoryRedis) -> None:
+        self._redis = redis
+        self._commands: list[tuple[str, tuple, dict]] = []
+
+    async def __aenter__(self) -> 'MemoryPipeline':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._commands.clear()
+
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs) -> 'MemoryPipeline':
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self) -> list:
+        self._redis.round_trips += 1
+        results = [
+            await getattr(MemoryRedis, name).__wrapped__(
+                self._redis, *args, **kwargs)
+            for name, args, kwargs in self._commands
+        ]
+        self._commands.clear()
+        return results
+
+
+class MemoryPubSub:
+    """Subscription receiving messages published to MemoryRedis"""
+
+    def __init__(self, redis: MemoryRedis) -> None:
+        self._redis = redis
+        self._channels: list[str] = []
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    async def subscribe(self, *channels: str) -> None:
+        for channel in channels:
+            self._redis._subscribers.setdefault(channel, []).append(
+                self._queue)
+            self._channels.append(channel)
+            self._queue.put_nowait({'type': 'subscribe',
+                                    'channel': channel.encode(),
+                                    'data': len(self._channels)})
+
+    async def listen(self):
+        while self._channels:
+            yield await self._queue.get()
+
+    async def aclose(self) -> None:
+        for channel in self._channels:
+            self._redis._subscribers[channel].remove(self._queue)
+        self._channels.clear()
+
+
+def _encode(value) -> bytes:
+    """Values are stored as redis returns them"""
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
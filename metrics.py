@@ -0,0 +1,157 @@
+import bisect
+import functools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Protocol, TypeVar
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar('F', bound=Callable[..., Awaitable[Any]])
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# observations of the update being handled, set when tracing is on
+current_trace: ContextVar[list | None] = ContextVar('current_trace',
+                                                    default=None)
+
+
+class MetricsSink(Protocol):
+    def observe(self, name: str, value: float,
+                labels: dict[str, str]) -> None:
+        ...
+
+
+class PrometheusSink:
+    """Aggregates observations into histograms in Prometheus text format"""
+
+    def __init__(self, buckets: dict[str, tuple] | None = None) -> None:
+        """
+        :param buckets: bucket bounds by metric name,
+         LATENCY_BUCKETS for names not listed
+        """
+        self._buckets = buckets or {}
+        # name -> labels -> [bucket counts..., +Inf count, sum]
+        self._series: dict[str, dict[tuple, list]] = {}
+
+    def observe(self, name: str, value: float,
+                labels: dict[str, str]) -> None:
+        buckets = self._buckets.get(name, LATENCY_BUCKETS)
+        series = self._series.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        row = series.get(key)
+        if row is None:
+            row = series[key] = [0] * (len(buckets) + 2)
+        row[bisect.bisect_left(buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self._series.items()):
+            buckets = self._buckets.get(name, LATENCY_BUCKETS)
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, row in series.items():
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), row):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}}} {}'.format(
+                        name, _labels(key + (('le', str(bound)),)),
+                        cumulative))
+                lines.append('{}_count{{{}}} {}'.format(
+                    name, _labels(key), cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    name, _labels(key), row[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class LogSink:
+    """Writes every observation to the log"""
+
+    def observe(self, name: str, value: float,
+                labels: dict[str, str]) -> None:
+        logger.info('%s %s %.6f', name, _labels(tuple(labels.items())),
+                    value)
+
+
+class Metrics:
+    """
+    Entry point of instrumentation, does nothing until it is enabled,
+     so instrumented code pays one attribute check when it is off
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.trace = False
+        self.sinks: list[MetricsSink] = []
+
+    def configure(self, enabled: bool, trace: bool = False,
+                  sinks: list[MetricsSink] | None = None) -> None:
+        """
+        :param enabled: collect observations
+        :param trace: log observations of every update, needs enabled
+        :param sinks: receivers of observations
+        """
+        self.enabled = enabled
+        self.trace = enabled and trace
+        self.sinks = sinks if sinks is not None else [PrometheusSink(
+            buckets={'strapi_response_bytes': SIZE_BUCKETS})]
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.append((name, value, labels))
+
+    def render(self) -> str:
+        """Prometheus text of the first PrometheusSink"""
+        for sink in self.sinks:
+            if isinstance(sink, PrometheusSink):
+                return sink.render()
+        return ''
+
+
+metrics = Metrics()
+
+
+def instrumented(func: F) -> F:
+    """Observe duration of Strapi method as strapi_method_seconds"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not metrics.enabled:
+            return await func(*args, **kwargs)
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.observe('strapi_method_seconds',
+                            time.perf_counter() - started,
+                            method=func.__name__, status=status)
+
+    return wrapper
+
+
+def setup_metrics(app: web.Application, path: str = '/metrics') -> None:
+    """Register Prometheus scrape endpoint"""
+
+    async def metrics_endpoint(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(),
+                            content_type='text/plain',
+                            charset='utf-8')
+
+    app.router.add_get(path, metrics_endpoint)
+
+
+def _labels(items: tuple) -> str:
+    return ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                    for key, value in items)
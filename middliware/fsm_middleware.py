@@ -0,0 +1,53 @@
+from typing import Awaitable, Dict, Callable, Any
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, StorageKey
+from aiogram.types import TelegramObject
+from aiogram import Bot
+from fsm_storage import BufferedFSMContext
+
+
+class BufferedFSMContextMiddleware(FSMContextMiddleware):
+    """
+    FSMContextMiddleware giving handlers BufferedFSMContext, changes of
+     state and data are written once after the handler
+    """
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        context = self.resolve_event_context(data['bot'], data)
+        data['fsm_storage'] = self.storage
+        if context is None:
+            return await handler(event, data)
+
+        async with self.events_isolation.lock(key=context.key):
+            data.update({'state': context,
+                         'raw_state': await context.get_state()})
+            try:
+                return await handler(event, data)
+            finally:
+                # changes made before an error are kept, as with
+                # unbuffered context
+                await context.flush()
+
+    def get_context(
+            self,
+            bot: Bot,
+            chat_id: int,
+            user_id: int,
+            thread_id: int | None = None,
+            business_connection_id: str | None = None,
+            destiny: str = DEFAULT_DESTINY,
+    ) -> BufferedFSMContext:
+        return BufferedFSMContext(
+            storage=self.storage,
+            key=StorageKey(
+                user_id=user_id,
+                chat_id=chat_id,
+                bot_id=bot.id,
+                thread_id=thread_id,
+                business_connection_id=business_connection_id,
+                destiny=destiny,
+            ))
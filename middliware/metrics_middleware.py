@@ -0,0 +1,82 @@
+import logging
+import time
+from typing import Awaitable, Dict, Callable, Any
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import (BaseRequestMiddleware,
+                                                     NextRequestMiddlewareType)
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType, Response
+from aiogram.types import TelegramObject, Update
+from metrics import metrics, current_trace
+
+logger = logging.getLogger(__name__)
+
+
+def handler_label(update: Update) -> str:
+    """Callback data prefix (Product, Cart, page_, ...) or kind of update"""
+    if update.callback_query is not None:
+        return (update.callback_query.data or '').split(':', 1)[0]
+    if update.message is not None:
+        text = update.message.text or ''
+        return text.split()[0] if text.startswith('/') else 'message'
+    return update.event_type
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Observe handler latency per callback prefix, trace updates"""
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        if not metrics.enabled:
+            return await handler(event, data)
+
+        label = handler_label(event)
+        trace = [] if metrics.trace else None
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            current_trace.reset(token)
+            metrics.observe('handler_seconds', elapsed,
+                            handler=label, status=status)
+            if trace is not None:
+                logger.info('update %s %s %s %.1fms: %s',
+                            event.update_id, label, status, elapsed * 1000,
+                            '; '.join('{} {} {:.1f}ms'.format(
+                                name, ' '.join(map(str, labels.values())),
+                                value * 1000)
+                                for name, value, labels in trace
+                                if name.endswith('_seconds')))
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Observe latency of Bot API calls"""
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not metrics.enabled:
+            return await make_request(bot, method)
+
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.observe('telegram_request_seconds',
+                            time.perf_counter() - started,
+                            method=type(method).__name__, status=status)
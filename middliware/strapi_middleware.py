@@ -1,4 +1,3 @@
-import os
 from typing import Awaitable, Dict, Callable, Any
 from aiogram.types import TelegramObject
 from aiogram import BaseMiddleware
@@ -7,6 +6,12 @@ from strapi import Strapi
 
 class StrapiCartsMiddleware(BaseMiddleware):
     """Dependency injection instance Strapi"""
+    def __init__(self, strapi: Strapi) -> None:
+        """
+        :param strapi: client created once at startup
+        """
+        self._strapi = strapi
+
     async def __call__(
             self,
             handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -14,9 +19,6 @@ class StrapiCartsMiddleware(BaseMiddleware):
             data: Dict[str, Any]
     ) -> Any:
 
-        data['strapi'] = Strapi(
-            token=os.getenv('STRAPI_PRODUCT_TOKEN'),
-            api_url=os.getenv('API_STRAPI_URL')
-        )
+        data['strapi'] = self._strapi
 
         return await handler(event, data)
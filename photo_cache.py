@@ -0,0 +1,59 @@
+from redis.asyncio import Redis
+
+
+class PhotoFileIdCache:
+    """Telegram file_id of uploaded product pictures stored in redis"""
+
+    def __init__(self, redis: Redis, prefix: str = 'photo_file_id') -> None:
+        """
+        :param redis: redis client, the one used by RedisStorage
+        :param prefix: prefix of redis keys
+        """
+        self._redis = redis
+        self._prefix = prefix
+
+    def _key(self, picture_hash: str) -> str:
+        return '{prefix}:{hash}'.format(prefix=self._prefix,
+                                        hash=picture_hash)
+
+    async def get(self, picture_hash: str) -> str | None:
+        """
+        Get file_id of picture uploaded before
+        :param picture_hash: ProductImageSize.hash, changes with picture
+        :return: telegram file_id or None
+        """
+        file_id = await self._redis.get(self._key(picture_hash))
+        if isinstance(file_id, bytes):
+            return file_id.decode()
+        return file_id
+
+    async def get_many(self, picture_hashes: list[str]) -> list[str | None]:
+        """
+        Get file_id of several pictures in one redis call
+        :param picture_hashes: ProductImageSize.hash of pictures
+        :return: telegram file_id or None in order of hashes
+        """
+        if not picture_hashes:
+            return []
+        file_ids = await self._redis.mget(
+            [self._key(picture_hash) for picture_hash in picture_hashes])
+        return [file_id.decode() if isinstance(file_id, bytes) else file_id
+                for file_id in file_ids]
+
+    async def set(self, picture_hash: str, file_id: str) -> None:
+        """
+        Remember file_id of uploaded picture
+        :param picture_hash: ProductImageSize.hash
+        :param file_id: file_id of the largest PhotoSize telegram returned
+        :return: None
+        """
+        await self._redis.set(self._key(picture_hash), file_id)
+
+    async def delete(self, *picture_hashes: str) -> None:
+        """
+        Forget file_id telegram does not accept any more
+        :param picture_hashes: ProductImageSize.hash of pictures
+        :return: None
+        """
+        await self._redis.delete(
+            *(self._key(picture_hash) for picture_hash in picture_hashes))
@@ -1,76 +1,499 @@
-from aiogram.client.session import aiohttp
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+import aiohttp
+from pydantic import BaseModel
+from metrics import metrics, instrumented
 from strapi_model import (
-    ProductStrapiModelList,
+    CatalogPage, CatalogResponse, SearchProduct, SearchResponse,
+    PictureResponse, ProductImageSize, ProductStrapiModelList,
     ProductStrapiModel, ShoppingCartStrapiModel,
-    QuantityProductsModelList,
-    QuantityProductsModel, ShoppingCartStrapiModelList)
+    QuantityProductsModel, QuantityProductsModelList,
+    ShoppingCartStrapiModelList)
 
+T = TypeVar('T')
+M = TypeVar('M', bound=BaseModel)
 
-class BaseSingleton(type):
-    _instances = {}
+logger = logging.getLogger(__name__)
 
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            instance = super().__call__(*args, **kwargs)
-            cls._instances[cls] = instance
-        return cls._instances[cls]
 
+class StrapiUnavailable(Exception):
+    """Circuit of strapi backend is open, requests fail fast"""
 
-class Strapi(metaclass=BaseSingleton):
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures, lets one probe request through
+     every reset_timeout seconds until one succeeds
+    """
+
+    def __init__(self, failures: int = 5,
+                 reset_timeout: float = 30.0) -> None:
+        """
+        :param failures: consecutive failures opening the circuit
+        :param reset_timeout: seconds before a probe request is allowed
+        """
+        self._threshold = failures
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+
+    @property
+    def closed(self) -> bool:
+        return self._opened_at is None
+
+    def allow(self) -> bool:
+        """Request may be sent"""
+        if self._opened_at is None:
+            return True
+        if time.monotonic() - self._opened_at >= self._reset_timeout:
+            # half-open, others keep failing fast until the probe ends
+            self._opened_at = time.monotonic()
+            return True
+        return False
+
+    def success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self._threshold:
+            if self._opened_at is None:
+                logger.warning('Strapi circuit opened after %s failures',
+                               self._failures)
+            self._opened_at = time.monotonic()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Connection errors, timeouts, 429 and 5xx answers"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight call"""
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable,
+                 func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Await func, or the call already started with the same key
+        :param key: key of identical calls, e.g. method name and params
+        :param func: coroutine function making the call
+        :return: result of the shared call
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        # a cancelled caller must not cancel the call shared with others
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # mark exception retrieved when every caller has gone
+            task.exception()
+
+
+class CatalogCache:
+    """In-process cache of catalog responses with stale-while-revalidate"""
+
+    def __init__(self, ttl: float = 60.0, stale_ttl: float = 300.0) -> None:
+        """
+        :param ttl: seconds a loaded value is served as fresh
+        :param stale_ttl: seconds after ttl a value is still served
+         while it is refreshed in background, later it is served
+         only when loading fails
+        """
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._entries: dict[Hashable, tuple[float, Any]] = {}
+        self._refreshing: dict[Hashable, asyncio.Task] = {}
+        self._flights = SingleFlight()
+        self.version = 0
+
+    async def get(self, key: Hashable,
+                  loader: Callable[[], Awaitable[T]]) -> T:
+        """
+        Get value by key, call loader when it is missing or expired
+        :param key: cache key
+        :param loader: coroutine function loading a fresh value
+        :return: cached or loaded value
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            age = time.monotonic() - stored_at
+            if age < self._ttl:
+                return value
+            if age < self._ttl + self._stale_ttl:
+                self._refresh(key, loader)
+                return value
+            try:
+                return await self._load(key, loader)
+            except Exception as error:
+                # strapi is down, expired catalog is better than nothing
+                logger.warning('Catalog %s served expired: %r', key, error)
+                return value
+        return await self._load(key, loader)
+
+    def invalidate(self) -> None:
+        """Evict every entry, loads started before are not stored"""
+        self._entries.clear()
+        self.version += 1
+
+    async def _load(self, key: Hashable,
+                    loader: Callable[[], Awaitable[T]]) -> T:
+        """
+        Load value and store it if cache was not invalidated meanwhile,
+         concurrent misses of one key share a single load
+        """
+        version = self.version
+
+        async def load() -> T:
+            value = await loader()
+            if version == self.version:
+                self._entries[key] = (time.monotonic(), value)
+            return value
+
+        # loads started before invalidation are not joined
+        return await self._flights.do((version, key), load)
+
+    def _refresh(self, key: Hashable,
+                 loader: Callable[[], Awaitable[Any]]) -> None:
+        """Start one background refresh per key"""
+        if key in self._refreshing:
+            return
+        task = asyncio.create_task(self._load(key, loader))
+        self._refreshing[key] = task
+        task.add_done_callback(
+            lambda done: self._refresh_done(key, done))
+
+    def _refresh_done(self, key: Hashable, task: asyncio.Task) -> None:
+        self._refreshing.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('Catalog refresh %s failed: %r',
+                           key, task.exception())
+
+
+class BoundedDict(OrderedDict):
+    """Dict forgetting the oldest inserted keys over maxsize"""
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+PRIMARY = 'primary'
+
+# catalog reads go to a read replica when one is configured
+DEFAULT_ROUTES = {
+    'get_product_all': 'replica',
+    'get_product_page': 'replica',
+    'get_product_by_id': 'replica',
+    'get_search_products': 'replica',
+    'get_product_pictures': 'replica',
+    'download_photo': 'replica',
+}
+
+
+class StrapiBackend:
+    """Address and token of one strapi instance"""
+
+    def __init__(self, api_url: str, token: str) -> None:
+        """
+        :param api_url: url of strapi REST API, e.g. 'http://host:1337/api/'
+        :param token: secret token from strapi settings
+        """
+        self.api_url = api_url
+        # uploads are served from the root, picture urls start with /
+        self.media_url = api_url.rstrip('/').removesuffix('/api')
+        self.headers = {'Authorization': 'bearer {}'.format(token)}
+
+
+class Strapi:
 
     def __init__(self,
                  token: str,
-                 api_url='http://localhost:1337/api/') -> None:
+                 api_url='http://localhost:1337/api/',
+                 backends: dict[str, StrapiBackend] | None = None,
+                 routes: dict[str, str] | None = None,
+                 pool_limit: int = 100,
+                 pool_limit_per_host: int = 0,
+                 keepalive_timeout: float = 30.0,
+                 timeout: float = 10.0,
+                 connect_timeout: float = 3.0,
+                 catalog_ttl: float = 60.0,
+                 catalog_stale_ttl: float = 300.0,
+                 cart_upsert_path: str | None = None,
+                 checkout_path: str | None = None,
+                 media_timeout: float | None = None,
+                 retries: int = 2,
+                 retry_backoff: float = 0.2,
+                 retry_max_backoff: float = 2.0,
+                 breaker_failures: int = 5,
+                 breaker_reset_timeout: float = 30.0,
+                 max_concurrency: int = 100,
+                 chunk_size: int = 64 * 1024) -> None:
         """
         :param token: secret token from strapi settings
         :param api_url:
          default 'http://localhost:1337/api/' for dev environments
+        :param backends: other strapi instances by name, e.g. 'replica',
+         token and api_url make the 'primary' backend
+        :param routes: backend name by method name, methods not listed
+         and names without backend go to primary, default DEFAULT_ROUTES
+        :param pool_limit: max open connections in the pool, 0 - no limit
+        :param pool_limit_per_host: max open connections to one host,
+         0 - no limit
+        :param keepalive_timeout: seconds an idle connection is kept open
+        :param timeout: total seconds for one request
+        :param connect_timeout: seconds to establish a connection
+        :param catalog_ttl: seconds the catalog is served from cache
+        :param catalog_stale_ttl: seconds an expired catalog is still
+         served while it is refreshed in background
+        :param cart_upsert_path: path of custom strapi endpoint adding
+         product to the user cart in one request, e.g. 'carts/add-product'
+        :param checkout_path: path of custom strapi endpoint validating
+         the cart, creating the order and closing the cart in one
+         transaction, e.g. 'carts/checkout'
+        :param media_timeout: total seconds for picture download,
+         default timeout
+        :param retries: extra attempts of GET after connection error,
+         timeout, 429 or 5xx
+        :param retry_backoff: seconds before first retry, doubled
+         every attempt, the delay is a random part of it
+        :param retry_max_backoff: max seconds between attempts
+        :param breaker_failures: consecutive failures of backend after
+         which its requests fail fast with StrapiUnavailable
+        :param breaker_reset_timeout: seconds before a failed backend
+         is probed again
+        :param max_concurrency: max outstanding requests to strapi,
+         others wait for a free slot
+        :param chunk_size: bytes read at once when a picture is
+         downloaded to file
         """
-        self._headers = {'Authorization': 'bearer {}'.format(token)}
-        self._api_url = api_url
-        self._session = aiohttp.ClientSession(raise_for_status=True)
+        self._backends = {**(backends or {}),
+                          PRIMARY: StrapiBackend(api_url, token)}
+        self._routes = DEFAULT_ROUTES if routes is None else routes
+        self._pool_limit = pool_limit
+        self._pool_limit_per_host = pool_limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._timeout = aiohttp.ClientTimeout(total=timeout,
+                                              connect=connect_timeout)
+        self._media_timeout = (aiohttp.ClientTimeout(total=media_timeout)
+                               if media_timeout else None)
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._retry_max_backoff = retry_max_backoff
+        self._breakers = {
+            name: CircuitBreaker(failures=breaker_failures,
+                                 reset_timeout=breaker_reset_timeout)
+            for name in self._backends
+        }
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._chunk_size = chunk_size
+        self._session: aiohttp.ClientSession | None = None
+        self._catalog = CatalogCache(ttl=catalog_ttl,
+                                     stale_ttl=catalog_stale_ttl)
+        self._catalog_listeners: list[Callable[[dict | None], None]] = []
+        self._cart_upsert_path = cart_upsert_path
+        self._checkout_path = checkout_path
+        # id_tg -> (cart id, {product id: (quantity-product id, quantity)}),
+        # quantities are last seen by this process, not used for writes
+        self._carts: BoundedDict[
+            int, tuple[int, dict[int, tuple[int, int]]]] = BoundedDict()
 
     async def __aenter__(self):
-        """Create session"""
-        if self._session.closed:
-            self._session = aiohttp.ClientSession(raise_for_status=True)
+        """Open pooled session if it is not open yet"""
+        await self.start()
         return self._session
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        """Exit session"""
-        await self._session.close()
+        """Keep session, the pool is closed by close() on shutdown"""
+
+    async def start(self) -> None:
+        """Create long-lived session with keep-alive connector"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_limit,
+                limit_per_host=self._pool_limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+                ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self._timeout,
+                raise_for_status=True)
+
+    async def close(self) -> None:
+        """Close session and all pooled connections"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    @property
+    def catalog_version(self) -> int:
+        """Grows every time cached catalog is invalidated"""
+        return self._catalog.version
+
+    def add_catalog_listener(
+            self, listener: Callable[[dict | None], None]) -> None:
+        """
+        Call listener on every catalog invalidation
+        :param listener: gets strapi webhook payload or None
+        """
+        self._catalog_listeners.append(listener)
+
+    def invalidate_catalog(self, event: dict | None = None) -> None:
+        """
+        Drop cached catalog, next read goes to the API
+        :param event: strapi webhook payload which caused it,
+         None when the change is unknown
+        """
+        self._catalog.invalidate()
+        for listener in self._catalog_listeners:
+            listener(event)
 
+    @instrumented
+    async def get_search_products(
+            self, page_size: int = 100) -> list[SearchProduct]:
+        """
+        Get titles, descriptions and prices of the whole catalog
+         page by page, not cached, it feeds the search index
+        :param page_size: count products in one request
+        :return: list of SearchProduct
+        """
+        products = []
+        page, page_count = 1, 1
+        while page <= page_count:
+            payload = {
+                'fields[0]': 'title',
+                'fields[1]': 'description',
+                'fields[2]': 'price',
+                'sort[0]': 'id:asc',
+                'pagination[page]': page,
+                'pagination[pageSize]': page_size,
+            }
+            response = await self._request_model(
+                SearchResponse, 'GET', 'products', params=payload,
+                backend=self._route('get_search_products'))
+            products.extend(response.data)
+            page_count = response.meta.pagination.pageCount
+            page += 1
+        return products
+
+    @instrumented
+    async def get_product_pictures(
+            self, page_size: int = 100) -> list[ProductImageSize]:
+        """
+        Get small pictures of the whole catalog page by page, not cached,
+         it feeds the image cache prewarm
+        :param page_size: count products in one request
+        :return: list of ProductImageSize
+        """
+        pictures = []
+        page, page_count = 1, 1
+        while page <= page_count:
+            payload = {
+                'fields[0]': 'title',
+                'populate[picture][fields][0]': 'formats',
+                'sort[0]': 'id:asc',
+                'pagination[page]': page,
+                'pagination[pageSize]': page_size,
+            }
+            response = await self._request_model(
+                PictureResponse, 'GET', 'products', params=payload,
+                backend=self._route('get_product_pictures'))
+            for product in response.data:
+                if product.attributes.picture is not None:
+                    pictures.extend(
+                        picture.attributes.formats.small
+                        for picture in product.attributes.picture.data or ())
+            page_count = response.meta.pagination.pageCount
+            page += 1
+        return pictures
+
+    @instrumented
     async def get_product_all(self) -> ProductStrapiModelList:
+        """Returns catalog from cache, loads it when expired."""
+        return await self._catalog.get('products', self._fetch_product_all)
+
+    async def _fetch_product_all(self) -> ProductStrapiModelList:
         """Receives API request data, returns class StrapiModelList."""
 
-        async with self._session.get(
-                url='{api_url}products'.format(
-                    api_url=self._api_url),
-                headers=self._headers) as response:
-            list_object = await response.json()
-            product_strapi = ProductStrapiModelList(**list_object)
-            return product_strapi
+        return await self._request_model(
+            ProductStrapiModelList, 'GET', 'products',
+            backend=self._route('get_product_all'))
+
+    @instrumented
+    async def get_product_page(self, page: int,
+                               page_size: int) -> CatalogPage:
+        """
+        Get one catalog page, served from cache when possible
+        :param page: number of page starting from 1
+        :param page_size: count products on page
+        :return: CatalogPage with ids and titles of products
+        """
+        return await self._catalog.get(
+            ('products', page, page_size),
+            lambda: self._fetch_product_page(page, page_size))
+
+    async def _fetch_product_page(self, page: int,
+                                  page_size: int) -> CatalogPage:
+        """Request only titles of the page products from API"""
+
+        payload = {
+            'fields[0]': 'title',
+            'sort[0]': 'id:asc',
+            'pagination[page]': page,
+            'pagination[pageSize]': page_size,
+        }
+        catalog = await self._request_model(
+            CatalogResponse, 'GET', 'products', params=payload,
+            backend=self._route('get_product_page'))
+        return CatalogPage(catalog)
 
+    @instrumented
     async def get_product_by_id(self, id_objects: int) -> ProductStrapiModel:
         """
-        Get model object by id model
+        Get model object by id model, served from catalog cache
         :param id_objects: id endpoints your request
         :return: class StrapiModel
         """
+        return await self._catalog.get(
+            ('product', id_objects),
+            lambda: self._fetch_product_by_id(id_objects))
+
+    async def _fetch_product_by_id(
+            self, id_objects: int) -> ProductStrapiModel:
+        """Request product with populated relations from API"""
 
         payload = {
             'populate': '*'
         }
-        response = await self._session.get(
-            url='{api_url}products/{id}'.format(
-                api_url=self._api_url,
-                id=id_objects),
-            headers=self._headers,
-            params=payload)
-        list_object = await response.json()
-        product_strapi = ProductStrapiModel(**list_object)
-        return product_strapi
+        return await self._request_model(
+            ProductStrapiModel,
+            'GET', 'products/{id}'.format(id=id_objects), params=payload,
+            backend=self._route('get_product_by_id'))
 
+    @instrumented
     async def get_cart_by_id(self, id_objects: int) -> ShoppingCartStrapiModel:
         """
         Get model object by id model
@@ -81,16 +504,12 @@ class Strapi(metaclass=BaseSingleton):
         payload = {
             'populate[quantity_products][populate][0]': 'product'
         }
-        response = await self._session.get(
-            url='{api_url}carts/{id}'.format(
-                api_url=self._api_url,
-                id=id_objects),
-            headers=self._headers,
-            params=payload)
-        list_object = await response.json()
-        shopping_cart_strapi = ShoppingCartStrapiModel(**list_object)
-        return shopping_cart_strapi
+        return await self._request_model(
+            ShoppingCartStrapiModel,
+            'GET', 'carts/{id}'.format(id=id_objects), params=payload,
+            backend=self._route('get_cart_by_id'))
 
+    @instrumented
     async def get_cart_by_filter(self, filter_field: str,
                                  filter: str) -> ShoppingCartStrapiModelList:
         """
@@ -105,233 +524,444 @@ class Strapi(metaclass=BaseSingleton):
             'populate[quantity_products][populate][0]': 'product',
             f'filters[{filter_field}][$eq]': filter
         }
-        response = await self._session.get(
-            url='{api_url}carts'.format(
-                api_url=self._api_url,
-            ),
-            headers=self._headers,
-            params=payload)
-        cart = await response.json()
-        shopping_cart_strapi = ShoppingCartStrapiModelList(**cart)
-        return shopping_cart_strapi
-
-    async def get_photo_bytes(self, id_objects: int) -> bytes:
-        """
-        generates image bytes from a request
-        :param id_objects: id model
-        :return: bytes
-        """
-        url_by_photo = self._api_url.strip('api/')
-        product_model = await self.get_product_by_id(id_objects)
-        for product in product_model.data.attributes.picture.data:
-            response = await self._session.get(
-                url='{api_url}{url}'.format(
-                    api_url=url_by_photo,
-                    url=product.attributes.formats.small.url
-                ),
-                headers=self._headers)
-            picture_bytes = await response.content.read()
-            return picture_bytes
-
-    async def create_user_cart(
-            self, product_id: int,
-            user_id: int, data_model: dict,
-            data_relation: dict,
-    ) -> None:
-        """
-        creates a cart model with product-quantity models
+        return await self._request_model(
+            ShoppingCartStrapiModelList, 'GET', 'carts', params=payload,
+            backend=self._route('get_cart_by_filter'))
 
-        :param product_id: product id by database
-        :param user_id: telegram id user
-        :param data_model: data format json {
-            'data': {
-                'field_model': values,
-            }
-        }
-        :param data_relation: data formats json {
-        'data': {
-            'your_field': value,
-        }
+    @instrumented
+    async def download_photo(self, url: str, path: str) -> None:
+        """
+        Stream picture to file without holding it in memory
+        :param url: url of picture relative to media server
+        :param path: file the picture is written to
         :return: None
         """
+        await self._request('GET', url, media=True, file=path,
+                            backend=self._route('download_photo'))
+
+    @property
+    def cart_upsert(self) -> bool:
+        """Cart changes go to the custom upsert endpoint"""
+        return self._cart_upsert_path is not None
+
+    @instrumented
+    async def change_product_quantity(
+            self, product_id: int, user_id: int, delta: int,
+            idempotency_key: str | None = None) -> tuple[int, int | None, int]:
+        """
+        Increment or decrement quantity of product in the user cart,
+         the line is created when it is missing and deleted at zero.
+         With cart_upsert_path it is one atomic request, repeated with
+         the same idempotency key it adds delta once. Otherwise it is
+         plan_product_quantity and set_product_quantity, a repeated call
+         adds delta again
 
-        cart_id = await self._get_or_create_cart(
+        :param product_id: product id by database
+        :param user_id: telegram id user
+        :param delta: added quantity, negative to take away
+        :param idempotency_key: same for every attempt of one change,
+         sent to cart_upsert_path as Idempotency-Key header
+        :return: cart id, quantity-product id or None if there is no line,
+         quantity saved in strapi
+        """
+        if self._cart_upsert_path is not None:
+            return await self._upsert_cart_product(
+                product_id=product_id,
+                user_id=user_id,
+                delta=delta,
+                idempotency_key=idempotency_key)
+
+        id_cart, id_quantity_product, quantity = (
+            await self.plan_product_quantity(product_id=product_id,
+                                             user_id=user_id,
+                                             delta=delta))
+        return await self.set_product_quantity(
+            product_id=product_id,
             user_id=user_id,
-            data_model=data_model)
-
-        product_quantity_id = await self._get_or_create_quantity_product(
-            shop_cart_id=cart_id,
-            data_model=data_model,
-            data_relation=data_relation,
-            product_id=product_id
-        )
-
-        await self._put_product_quantity(
-            quantity_product_id=product_quantity_id,
-            data_relation=data_relation
-        )
-
-    async def deleted_product(self, id_object: int) -> None:
+            id_cart=id_cart,
+            id_quantity_product=id_quantity_product,
+            quantity=quantity,
+            lookup=False)
+
+    @instrumented
+    async def plan_product_quantity(
+            self, product_id: int, user_id: int,
+            delta: int) -> tuple[int, int | None, int]:
+        """
+        Quantity of product in the user cart after adding delta, nothing
+         is written. Cart id is cached, the line is read from strapi
+         unless the cart was loaded right now
+        :param product_id: product id by database
+        :param user_id: telegram id user
+        :param delta: added quantity, negative to take away
+        :return: cart id, quantity-product id or None if there is no line,
+         new quantity, not below zero
+        """
+        # lines of a cart loaded right now are current, no lookup needed
+        loaded = user_id not in self._carts
+        if loaded:
+            self._carts[user_id] = await self._get_or_create_cart(
+                user_id=user_id,
+                data_model={'data': {'id_tg': user_id}})
+        cart_id, lines = self._carts[user_id]
+
+        if loaded:
+            line = lines.get(product_id)
+        else:
+            # other processes change the cart too, cached quantity
+            # may be stale
+            line = await self._find_quantity_product(
+                shop_cart_id=cart_id,
+                product_id=product_id)
+        if line is None:
+            return cart_id, None, max(delta, 0)
+        return cart_id, line[0], max(line[1] + delta, 0)
+
+    @instrumented
+    async def set_product_quantity(
+            self, product_id: int, user_id: int, id_cart: int,
+            id_quantity_product: int | None, quantity: int,
+            lookup: bool = True) -> tuple[int, int | None, int]:
+        """
+        Write quantity planned by plan_product_quantity, the line is
+         created, updated or deleted at zero. A repeated call leaves the
+         same quantity, so it is safe to retry: a missing line is looked
+         up first, it may have been created by a call whose answer was lost
+        :param product_id: product id by database
+        :param user_id: telegram id user
+        :param id_cart: cart id returned by plan_product_quantity
+        :param id_quantity_product: line returned by plan_product_quantity
+        :param quantity: quantity to save
+        :param lookup: look up a missing line, False for the first call
+         right after plan_product_quantity
+        :return: cart id, quantity-product id or None if there is no line,
+         quantity saved in strapi
+        """
+        _, lines = self._carts.get(user_id) or (id_cart, {})
+        if id_quantity_product is None:
+            if quantity <= 0:
+                return id_cart, None, 0
+            line = await self._find_quantity_product(
+                shop_cart_id=id_cart,
+                product_id=product_id) if lookup else None
+            if line is None:
+                quantity_product = await self._request_model(
+                    QuantityProductsModel, 'POST', 'quantity-products',
+                    json_data={'data': {
+                        'product': product_id,
+                        'quantity': quantity,
+                        'cart': id_cart,
+                    }})
+                lines[product_id] = (quantity_product.data.id, quantity)
+                return id_cart, quantity_product.data.id, quantity
+            id_quantity_product = line[0]
+
+        path = 'quantity-products/{id}'.format(id=id_quantity_product)
+        try:
+            if quantity > 0:
+                await self._request('PUT', path, json_data={
+                    'data': {'quantity': quantity}})
+                lines[product_id] = (id_quantity_product, quantity)
+                return id_cart, id_quantity_product, quantity
+            await self._request('DELETE', path)
+        except aiohttp.ClientResponseError as error:
+            if error.status != 404:
+                raise
+            if quantity > 0:
+                # cart or line was removed outside the bot, cache is stale
+                self._carts.pop(user_id, None)
+                raise
+            # deleted by the attempt whose answer was lost
+        lines.pop(product_id, None)
+        return id_cart, id_quantity_product, 0
+
+    @instrumented
+    async def deleted_product(self, id_object: int,
+                              user_id: int | None = None) -> None:
         """
         Deleted object from strapi
         :param id_object: id product_quantity model
+        :param user_id: telegram id of cart owner, to update cached ids
         :return: None
         """
-        await self._session.delete(
-            url='{api_url}quantity-products/{id}'.format(
-                api_url=self._api_url,
-                id=id_object),
-            headers=self._headers)
-
-    async def create_order_user(self, email: str, id_cart: int,
-                                total_price: int) -> bool:
+        await self._request(
+            'DELETE', 'quantity-products/{id}'.format(id=id_object))
+
+        carts = ([self._carts.get(user_id)] if user_id is not None
+                 else list(self._carts.values()))
+        for cart in carts:
+            if cart is None:
+                continue
+            lines = cart[1]
+            for product_id, (line_id, _) in list(lines.items()):
+                if line_id == id_object:
+                    del lines[product_id]
+
+    @instrumented
+    async def checkout(self, id_cart: int, user_id: int, email: str,
+                       total_price: int, idempotency_key: str) -> None:
         """
-        Create Order if not Order no active (unpublished order)
+        Place order of the user cart and close the cart, one request to
+         checkout_path when it is configured, otherwise one PUT of cart.
+         Repeated calls with the same key place one order, so the request
+         is retried like GET
+        :param id_cart: id cart user
+        :param user_id: telegram id of cart owner
         :param email: email user
-        :param id_cart: id shopping cart user
         :param total_price: sum Order
-        :return: True if create order, False if order has already
+        :param idempotency_key: same for every attempt of one checkout
+        :return: None
         """
-
-        payload = {'filters[email][$eq]': email}
-
-        order_response = await self._session.get(
-            url='{api_url}carts'.format(
-                api_url=self._api_url,
-            ),
-            headers=self._headers,
-            params=payload)
-        order = await order_response.json()
-        if order.get('data'):
-            return False
-        data_order = {
-            'data': {
-                'cart': id_cart,
-                'email': email,
-                'total_price': total_price,
+        if self._checkout_path is not None:
+            data = {
+                'data': {
+                    'id_tg': user_id,
+                    'cart': id_cart,
+                    'email': email,
+                    'total_price': total_price,
+                }
             }
-        }
-        await self._session.post(
-            url='{api_url}carts'.format(
-                api_url=self._api_url,
-            ),
-            headers=self._headers,
-            json=data_order)
-        return True
+            await self._request('POST', self._checkout_path, json_data=data,
+                                idempotency_key=idempotency_key)
+        else:
+            data_cart = {
+                'data': {
+                    'email': email,
+                    'total_price': total_price,
+                    'publishedAt': None,
+                }
+            }
+            await self._request('PUT', 'carts/{id}'.format(id=id_cart),
+                                json_data=data_cart,
+                                idempotency_key=idempotency_key)
 
-    async def unpublished_cart(self, id_cart: int) -> None:
+        self._carts.pop(user_id, None)
+
+    async def _upsert_cart_product(
+            self, product_id: int, user_id: int, delta: int,
+            idempotency_key: str | None) -> tuple[int, int | None, int]:
         """
-        Completing the active cart
-        :param id_cart: id cart user
-        :return: None
+        Change quantity with custom endpoint, it gets or creates cart,
+         adds increment to quantity-product in one transaction, deletes
+         the line at zero and answers {
+            'data': {'cart': id, 'quantity_product': id, 'quantity': n}
+        }
         """
-
-        data_cart = {
+        data = {
             'data': {
-                'publishedAt': None
+                'id_tg': user_id,
+                'product': product_id,
+                'increment': delta,
             }
         }
-
-        payload = {'populate': '*'}
-
-        await self._session.put(
-            url='{api_url}carts/{id}'.format(
-                api_url=self._api_url,
-                id=id_cart),
-            headers=self._headers,
-            json=data_cart,
-            params=payload)
+        upsert = (await self._request_json(
+            'POST', self._cart_upsert_path, json_data=data,
+            idempotency_key=idempotency_key)).get('data')
+
+        cart_id, lines = self._carts.get(user_id) or (upsert.get('cart'), {})
+        if cart_id != upsert.get('cart'):
+            cart_id, lines = upsert.get('cart'), {}
+        quantity_product_id = upsert.get('quantity_product')
+        quantity = upsert.get('quantity') or 0
+        if quantity_product_id is None or quantity <= 0:
+            lines.pop(product_id, None)
+        else:
+            lines[product_id] = (quantity_product_id, quantity)
+        self._carts[user_id] = (cart_id, lines)
+        return cart_id, quantity_product_id, quantity
 
     async def _get_or_create_cart(
-            self, user_id: int, data_model: dict) -> int:
-        """Create or get cart id"""
+            self, user_id: int,
+            data_model: dict) -> tuple[int, dict[int, tuple[int, int]]]:
+        """Create or get cart id with ids and quantities of its lines"""
         payload = {
             'populate[quantity_products][populate][0]': 'product',
             'filters[id_tg][$eq]': user_id,
         }
-        shop_cart_response = await self._session.get(
-            url='{api_url}carts'.format(
-                api_url=self._api_url,
-            ),
-            headers=self._headers,
-            params=payload)
-        shop_cart = await shop_cart_response.json()
-        if not shop_cart.get('data'):
-            shop_cart_response = await self._session.post(
-                url='{api_url}carts'.format(
-                    api_url=self._api_url,
-                ),
-                headers=self._headers,
-                json=data_model)
-            shop_cart = await shop_cart_response.json()
-            return shop_cart.get('data').get('id')
-        return shop_cart.get('data')[0].get('id')
-
-    async def _get_or_create_quantity_product(
+        shop_carts = await self._request_model(
+            ShoppingCartStrapiModelList, 'GET', 'carts', params=payload)
+        if not shop_carts.data:
+            shop_cart = await self._request_json('POST', 'carts',
+                                                 json_data=data_model)
+            return shop_cart.get('data').get('id'), {}
+
+        cart = shop_carts.data[0]
+        lines = {}
+        if cart.attributes.quantity_products:
+            for line in cart.attributes.quantity_products.data:
+                if line.attributes.product:
+                    lines[line.attributes.product.data.id] = (
+                        line.id, line.attributes.quantity)
+        return cart.id, lines
+
+    async def _find_quantity_product(
             self, shop_cart_id: int,
-            data_model: dict,
-            data_relation: dict,
-            product_id: int) -> int:
-        """Create or get quantity-product id"""
+            product_id: int) -> tuple[int, int] | None:
+        """
+        Get quantity-product id and quantity of product in cart or None,
+         the line is filtered by cart and product on server side
+        """
         payload = {
-            'populate[product][populate][0]': 'id',
-            'filters[cart][id][$eq]': shop_cart_id}
-
-        quantity_product_request = await self._session.get(
-            url='{api_url}quantity-products'.format(
-                api_url=self._api_url,
-            ),
-            headers=self._headers,
-            params=payload)
-
-        quantity_product_response = await quantity_product_request.json()
-
-        quantity_product = QuantityProductsModelList(
-            **quantity_product_response
-        )
-
-        quantity_product_id = 0
-        for id_product_by_cats in quantity_product.data:
-            if id_product_by_cats.attributes.product.data.id == product_id:
-                quantity_product_id = id_product_by_cats.id
-
-        if (not quantity_product_response.get('data')
-                or quantity_product_id == 0):
-            quantity_product_request = await self._session.post(
-                url='{api_url}quantity-products'.format(
-                    api_url=self._api_url,
-                ),
-                headers=self._headers,
-                json=data_relation)
-
-            quantity_product_response = await quantity_product_request.json()
-
-            quantity_product = QuantityProductsModel(
-                **quantity_product_response
-            )
-
-            quantity_product_id = quantity_product.data.id
+            'filters[cart][id][$eq]': shop_cart_id,
+            'filters[product][id][$eq]': product_id,
+            'pagination[pageSize]': 1,
+        }
 
-            data_model.get('data')['quantity_products'] = {
-                'connect': [quantity_product_id]
-            }
+        quantity_products = await self._request_model(
+            QuantityProductsModelList, 'GET', 'quantity-products',
+            params=payload)
 
-            await self._session.put(
-                url='{api_url}carts/{cart_id}'.format(
-                    api_url=self._api_url,
-                    cart_id=shop_cart_id),
-                headers=self._headers,
-                json=data_model)
-
-        return quantity_product_id
-
-    async def _put_product_quantity(self, quantity_product_id: int,
-                                    data_relation: dict):
-        """Update quantity-product model"""
-        await self._session.put(
-            url='{api_url}quantity-products/{id}'.format(
-                api_url=self._api_url,
-                id=quantity_product_id
-            ),
-            headers=self._headers,
-            json=data_relation)
+        if quantity_products.data:
+            line = quantity_products.data[0]
+            return line.id, line.attributes.quantity
+        return None
+
+    def _route(self, method_name: str) -> str:
+        """Name of backend serving Strapi method"""
+        return self._routes.get(method_name, PRIMARY)
+
+    async def _request(self, method: str, path: str,
+                       params: dict | None = None,
+                       json_data: dict | None = None,
+                       backend: str = PRIMARY,
+                       media: bool = False,
+                       timeout: aiohttp.ClientTimeout | None = None,
+                       idempotency_key: str | None = None,
+                       file: str | None = None) -> bytes:
+        """
+        Send request to strapi, every call of the client goes through it,
+         GET and requests with idempotency key are retried with
+         exponential backoff and jitter
+        :param method: http method
+        :param path: path relative to api url of backend
+        :param params: query string
+        :param json_data: json body
+        :param backend: name of backend, primary if it is not configured
+        :param media: path is relative to media server, not to REST API
+        :param timeout: timeout of this call instead of session one
+        :param idempotency_key: sent as Idempotency-Key header
+        :param file: path the body is streamed to in chunks, it is
+         rewritten by every attempt
+        :return: raw response body, empty when it is written to file
+        """
+        if backend not in self._backends:
+            backend = PRIMARY
+        if media and timeout is None:
+            timeout = self._media_timeout
+        attempts = (1 + self._retries
+                    if method == 'GET' or idempotency_key is not None else 1)
+
+        for attempt in range(attempts):
+            try:
+                return await self._send(method, path, params=params,
+                                        json_data=json_data,
+                                        backend=backend, media=media,
+                                        timeout=timeout,
+                                        idempotency_key=idempotency_key,
+                                        file=file)
+            except Exception as error:
+                if attempt + 1 >= attempts or not is_retryable(error):
+                    raise
+                logger.info('Retry %s %s after %r', method, path, error)
+            await asyncio.sleep(random.uniform(0, min(
+                self._retry_max_backoff,
+                self._retry_backoff * 2 ** attempt)))
+
+    async def _send(self, method: str, path: str,
+                    params: dict | None, json_data: dict | None,
+                    backend: str, media: bool,
+                    timeout: aiohttp.ClientTimeout | None,
+                    idempotency_key: str | None = None,
+                    file: str | None = None) -> bytes:
+        """One attempt of request through circuit breaker of backend"""
+        strapi = self._backends[backend]
+        breaker = self._breakers[backend]
+        if not breaker.allow():
+            raise StrapiUnavailable(
+                'Strapi backend {} is unavailable'.format(backend))
+
+        async with self._semaphore:
+            started = time.perf_counter()
+            status = 'error'
+            body = b''
+            size = 0
+            try:
+                async with self._session.request(
+                        method,
+                        url='{api_url}{path}'.format(
+                            api_url=(strapi.media_url if media
+                                     else strapi.api_url),
+                            path=path),
+                        headers=(strapi.headers if idempotency_key is None
+                                 else {**strapi.headers,
+                                       'Idempotency-Key': idempotency_key}),
+                        params=params,
+                        json=json_data,
+                        timeout=timeout or self._timeout) as response:
+                    status = str(response.status)
+                    if file is None:
+                        body = await response.read()
+                        size = len(body)
+                    else:
+                        with open(file, 'wb') as output:
+                            async for chunk in response.content.iter_chunked(
+                                    self._chunk_size):
+                                output.write(chunk)
+                                size += len(chunk)
+                breaker.success()
+                return body
+            except aiohttp.ClientResponseError as error:
+                status = str(error.status)
+                if error.status >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.failure()
+                raise
+            finally:
+                if metrics.enabled:
+                    resource = path.strip('/').split('/', 1)[0]
+                    metrics.observe('strapi_request_seconds',
+                                    time.perf_counter() - started,
+                                    method=method, resource=resource,
+                                    status=status, backend=backend)
+                    metrics.observe('strapi_response_bytes', size,
+                                    method=method, resource=resource)
+
+    async def _request_json(self, method: str, path: str,
+                            params: dict | None = None,
+                            json_data: dict | None = None,
+                            backend: str = PRIMARY,
+                            idempotency_key: str | None = None) -> Any:
+        """Send request to strapi and decode json answer"""
+        body = await self._request(method, path, params=params,
+                                   json_data=json_data, backend=backend,
+                                   idempotency_key=idempotency_key)
+        return json.loads(body) if body else None
+
+    async def _request_model(self, model: type[M], method: str, path: str,
+                             params: dict | None = None,
+                             json_data: dict | None = None,
+                             backend: str = PRIMARY) -> M:
+        """Send request to strapi and validate answer into model"""
+        body = await self._request(method, path, params=params,
+                                   json_data=json_data, backend=backend)
+        return self._validate(model, body)
+
+    @staticmethod
+    def _validate(model: type[M], body: bytes) -> M:
+        """
+        Build model right from response bytes, without intermediate dict,
+         time spent is observed
+        """
+        if not metrics.enabled:
+            return model.model_validate_json(body)
+        started = time.perf_counter()
+        try:
+            return model.model_validate_json(body)
+        finally:
+            metrics.observe('strapi_validate_seconds',
+                            time.perf_counter() - started,
+                            model=model.__name__)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, NamedTuple
 from pydantic import BaseModel
 
 
@@ -21,7 +21,8 @@ class ProductImageList(BaseModel):
 
 
 class ProductPictures(BaseModel):
-    data: list[ProductImageList]
+    # strapi sends null for a product without pictures
+    data: Optional[list[ProductImageList]] | None = None
 
 
 class ProductAttributes(BaseModel):
@@ -37,14 +38,95 @@ class Products(BaseModel):
     attributes: ProductAttributes
 
 
+class Pagination(BaseModel):
+    page: int
+    pageSize: int
+    pageCount: int
+    total: int
+
+
+class Meta(BaseModel):
+    pagination: Optional[Pagination] | None = None
+
+
 class ProductStrapiModelList(BaseModel):
     data: list[Products]
+    meta: Optional[Meta] | None = None
 
 
 class ProductStrapiModel(BaseModel):
     data: Products
 
 
+class CatalogTitle(BaseModel):
+    title: str
+
+
+class CatalogProduct(BaseModel):
+    id: int
+    attributes: CatalogTitle
+
+
+class CatalogResponse(BaseModel):
+    """Catalog page requested with fields[0]=title"""
+    data: list[CatalogProduct]
+    meta: Meta
+
+
+class SearchAttributes(BaseModel):
+    title: str
+    description: str
+    price: int
+
+
+class SearchProduct(BaseModel):
+    id: int
+    attributes: SearchAttributes
+
+
+class SearchResponse(BaseModel):
+    """Catalog page requested with fields title, description and price"""
+    data: list[SearchProduct]
+    meta: Meta
+
+
+class PictureAttributes(BaseModel):
+    picture: Optional[ProductPictures] | None = None
+
+
+class PictureProduct(BaseModel):
+    id: int
+    attributes: PictureAttributes
+
+
+class PictureResponse(BaseModel):
+    """Catalog page requested with populated picture formats"""
+    data: list[PictureProduct]
+    meta: Meta
+
+
+class CatalogRow(NamedTuple):
+    """Product in catalog list, only what the keyboard shows"""
+    id: int
+    title: str
+
+
+class CatalogPage:
+    """
+    Page of catalog for list views, keeps only ids and titles of
+    products. ProductAttributes are validated only in product detail
+    """
+    __slots__ = ('rows', 'pagination')
+
+    def __init__(self, response: CatalogResponse) -> None:
+        """
+        :param response: page validated from strapi response bytes
+        """
+        self.rows = [CatalogRow(product.id, product.attributes.title)
+                     for product in response.data]
+        self.pagination = response.meta.pagination
+
+
 class QuantityProductsCartAttributes(BaseModel):
     quantity: int
     product: Optional[ProductStrapiModel] | None = None
@@ -0,0 +1,23 @@
+import time
+from types import SimpleNamespace
+import pytest
+import strapi
+
+
+class Clock:
+    """monotonic of strapi module moved by tests"""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    # the event loop keeps the real clock
+    monkeypatch.setattr(strapi, 'time', SimpleNamespace(
+        monotonic=clock.monotonic, perf_counter=time.perf_counter))
+    return clock
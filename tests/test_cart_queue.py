@@ -0,0 +1,164 @@
+import asyncio
+import json
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from benchmarks.mock_strapi import MockStrapi
+from cart_queue import CartWriteQueue, merge_changes
+from cart_store import CartStore
+from memory_redis import MemoryRedis
+from strapi import Strapi
+
+
+def change(product: int, delta: int, **fields) -> dict:
+    return {'op': 'change', 'product': product, 'delta': delta, **fields}
+
+
+def test_merge_changes_sums_consecutive_deltas():
+    assert merge_changes([change(1, 1), change(1, 2), change(2, 1)]) == [
+        (change(1, 3), 2), (change(2, 1), 1)]
+
+
+def test_merge_changes_cancelled_out():
+    assert merge_changes([change(1, 1), change(1, -1)]) == [(None, 2)]
+
+
+def test_merge_changes_keeps_order_of_products():
+    changes = [change(1, 1), change(2, 1), change(1, 1)]
+    assert merge_changes(changes) == [(item, 1) for item in changes]
+
+
+def test_merge_changes_other_ops_not_merged():
+    remove = {'op': 'remove', 'quantity_product': 7}
+    assert merge_changes([change(1, 1), remove, change(1, 1)]) == [
+        (change(1, 1), 1), (remove, 1), (change(1, 1), 1)]
+    assert merge_changes([]) == []
+
+
+def test_merge_changes_sent_change_not_merged():
+    sent = change(1, 1, sent=True)
+    assert merge_changes([sent, change(1, 1), change(1, 1)]) == [
+        (sent, 1), (change(1, 2), 2)]
+
+
+def lose_answers(mock_strapi: MockStrapi, method: str, path: str,
+                 count: int = 1) -> web.Application:
+    """App of mock applying first requests but answering them with 503"""
+    lost = [count]
+
+    @web.middleware
+    async def lose(request: web.Request, handler):
+        response = await handler(request)
+        if (request.method == method and request.path == path
+                and lost[0] > 0):
+            lost[0] -= 1
+            raise web.HTTPServiceUnavailable()
+        return response
+
+    app = mock_strapi.create_app()
+    app.middlewares.append(lose)
+    return app
+
+
+async def run_queue(app: web.Application, changes: list[dict],
+                    **strapi_kwargs) -> None:
+    """Apply changes queued for user 1 as left by a stopped process"""
+    async with TestServer(app) as server:
+        strapi = Strapi(token='test', api_url=str(server.make_url('/api/')),
+                        retry_backoff=0, **strapi_kwargs)
+        redis = MemoryRedis()
+        cart_queue = CartWriteQueue(redis, strapi, CartStore(redis),
+                                    retry_delay=0)
+        for item in changes:
+            await redis.rpush('cart_queue:1', json.dumps(item))
+        await redis.sadd('cart_queue:users', 1)
+        await cart_queue.start(bot=None)
+        await cart_queue.wait(1)
+        assert await redis.llen('cart_queue:1') == 0
+        await strapi.close()
+
+
+def quantity(mock_strapi: MockStrapi, id_product: int) -> int | None:
+    for line in mock_strapi.lines.values():
+        if line['product'] == id_product:
+            return line['quantity']
+    return None
+
+
+def test_upsert_retried_after_lost_answer_adds_once():
+    mock_strapi = MockStrapi(products=3, cart_lines=1, users=1)
+    app = lose_answers(mock_strapi, 'POST', '/api/carts/add-product')
+    asyncio.run(run_queue(app, [change(1, 1, key='a')],
+                          cart_upsert_path='carts/add-product'))
+    assert quantity(mock_strapi, 1) == 2
+    assert mock_strapi.calls['POST /api/carts/add-product'] == 2
+
+
+def test_fallback_retried_after_lost_answer_adds_once():
+    mock_strapi = MockStrapi(products=3, cart_lines=1, users=1)
+    id_line = next(iter(mock_strapi.lines))
+    app = lose_answers(mock_strapi, 'PUT',
+                       '/api/quantity-products/{}'.format(id_line))
+    asyncio.run(run_queue(app, [change(1, 1, key='a')]))
+    assert quantity(mock_strapi, 1) == 2
+    assert mock_strapi.calls['PUT /api/quantity-products/{id}'] == 2
+
+
+def test_fallback_new_line_retried_after_lost_answer_created_once():
+    mock_strapi = MockStrapi(products=3, cart_lines=1, users=1)
+    app = lose_answers(mock_strapi, 'POST', '/api/quantity-products')
+    asyncio.run(run_queue(app, [change(2, 1, key='a')]))
+    assert quantity(mock_strapi, 2) == 1
+    assert len(mock_strapi.lines) == 2
+    assert mock_strapi.calls['POST /api/quantity-products'] == 1
+
+
+def test_sent_change_replayed_after_restart_adds_once():
+    mock_strapi = MockStrapi(products=3, cart_lines=1, users=1)
+    id_line = next(iter(mock_strapi.lines))
+    # stopped after the write reached strapi, before the queue was trimmed
+    mock_strapi.lines[id_line]['quantity'] = 2
+    sent = change(1, 1, key='a', sent=True, cart=1, line=id_line,
+                  quantity=2)
+    asyncio.run(run_queue(mock_strapi.create_app(),
+                          [sent, change(1, 1, key='b')]))
+    assert quantity(mock_strapi, 1) == 3
+
+    mock_strapi.upserts['c'] = {'cart': 1, 'quantity_product': id_line,
+                                'quantity': 3}
+    asyncio.run(run_queue(mock_strapi.create_app(),
+                          [change(1, 1, key='c', sent=True)],
+                          cart_upsert_path='carts/add-product'))
+    assert quantity(mock_strapi, 1) == 3
+
+
+def test_wait_bounded_while_lock_of_crashed_process_is_held():
+    async def main() -> tuple:
+        redis = MemoryRedis()
+        cart_queue = CartWriteQueue(redis, None, CartStore(redis),
+                                    retry_delay=0.01)
+        await redis.set('cart_queue:1:lock', 'crashed', ex=60)
+        await cart_queue.change_quantity(1, 1)
+        written = await cart_queue.wait(1, timeout=0.1)
+        await cart_queue.stop(timeout=0)
+        return written, await redis.llen('cart_queue:1')
+
+    assert asyncio.run(main()) == (False, 1)
+
+
+def test_wait_sees_queue_written_by_another_process():
+    async def main() -> bool:
+        redis = MemoryRedis()
+        cart_queue = CartWriteQueue(redis, None, CartStore(redis))
+        # queued by this user on another replica
+        await redis.rpush('cart_queue:1', json.dumps(change(1, 1)))
+
+        async def written_by_replica() -> None:
+            await asyncio.sleep(0.1)
+            await redis.ltrim('cart_queue:1', 1, -1)
+
+        replica = asyncio.create_task(written_by_replica())
+        written = await cart_queue.wait(1, timeout=2)
+        assert replica.done()
+        return written
+
+    assert asyncio.run(main())
@@ -0,0 +1,47 @@
+import asyncio
+from strapi import CatalogCache
+
+
+def test_catalog_cache_serves_stale_and_refreshes(clock):
+    loads = []
+
+    async def loader() -> int:
+        loads.append(1)
+        return len(loads)
+
+    async def main() -> list:
+        cache = CatalogCache(ttl=60, stale_ttl=300)
+        values = [await cache.get('page', loader)]
+        clock.now += 30
+        values.append(await cache.get('page', loader))
+        clock.now += 60
+        # stale value now, refresh goes in background
+        values.append(await cache.get('page', loader))
+        while len(loads) < 2:
+            await asyncio.sleep(0)
+        values.append(await cache.get('page', loader))
+        return values
+
+    assert asyncio.run(main()) == [1, 1, 1, 2]
+    assert len(loads) == 2
+
+
+def test_catalog_cache_invalidate_drops_running_load():
+    async def main() -> tuple:
+        cache = CatalogCache()
+        release = asyncio.Event()
+
+        async def old() -> str:
+            await release.wait()
+            return 'old'
+
+        async def new() -> str:
+            return 'new'
+
+        running = asyncio.create_task(cache.get('page', old))
+        await asyncio.sleep(0)
+        cache.invalidate()
+        release.set()
+        return await running, await cache.get('page', new)
+
+    assert asyncio.run(main()) == ('old', 'new')
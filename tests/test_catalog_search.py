@@ -0,0 +1,124 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from benchmarks.mock_strapi import MockStrapi
+from catalog_search import CatalogIndex, SearchResult, TokenIndex
+from strapi import Strapi
+from webhooks.strapi_webhook import setup_strapi_webhook
+
+SECRET = 'webhook-secret'
+
+
+class NoStrapi:
+    """Strapi stand-in for indexes filled by put()"""
+
+    def add_catalog_listener(self, listener) -> None:
+        pass
+
+
+def test_token_index_finds_by_prefix():
+    index = TokenIndex()
+    index.add('карп', 1)
+    index.add('карась', 2)
+    index.add('окунь', 2)
+    assert index.find(['кар']) == {1, 2}
+    assert index.find(['кар', 'окунь']) == {2}
+    assert index.find(['щука']) == set()
+    assert index.find([]) == set()
+
+
+def test_token_index_short_word_matches_whole_token():
+    index = TokenIndex()
+    index.add('ёж', 1)
+    index.add('ёжик', 2)
+    assert index.find(['ёж']) == {1}
+
+
+def test_token_index_discard():
+    index = TokenIndex()
+    index.add('карп', 1)
+    index.add('карп', 2)
+    index.discard('карп', 1)
+    assert index.find(['карп']) == {2}
+    index.discard('карп', 2)
+    index.discard('щука', 2)
+    assert index.find(['кар']) == set()
+    assert index._vocabulary == []
+
+
+def test_token_index_discard_in_bulk_load():
+    index = TokenIndex()
+    for token in ('щука', 'карп', 'окунь'):
+        index.add(token, 1, sort=False)
+    # vocabulary is unsorted, discard must not remove another token
+    index.discard('окунь', 1)
+    index.sort()
+    assert index.find(['щука']) == {1}
+    assert index.find(['карп']) == {1}
+    assert index.find(['окунь']) == set()
+
+
+def test_catalog_index_put_replaces_text():
+    index = CatalogIndex(NoStrapi())
+    index.put(SearchResult(1, 'Карп зеркальный', 'Свежий', 300))
+    index.put(SearchResult(2, 'Щука', 'Карп не входит', 500))
+    assert [product.id for product in index.search('карп')] == [1, 2]
+
+    index.put(SearchResult(1, 'Окунь', 'Речной', 200))
+    assert [product.id for product in index.search('карп')] == [2]
+    assert [product.id for product in index.search('окун')] == [1]
+
+    index.remove(2)
+    index.remove(3)
+    assert index.search('карп') == []
+    assert len(index) == 1
+
+
+async def wait_for(condition, timeout: float = 2.0) -> None:
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('condition not met in {} seconds'.format(timeout))
+
+
+async def check_reload_by_webhook() -> None:
+    mock_strapi = MockStrapi(products=30)
+    async with TestServer(mock_strapi.create_app()) as strapi_server:
+        strapi = Strapi(token='test',
+                        api_url=str(strapi_server.make_url('/api/')))
+        index = CatalogIndex(strapi, page_size=10)
+        await index.start()
+        await index.ready()
+        assert len(index) == 30
+
+        app = web.Application()
+        setup_strapi_webhook(app, strapi, '/strapi/webhook', SECRET)
+        async with TestClient(TestServer(app)) as client:
+            mock_strapi.products[3]['attributes']['title'] = 'Осетр'
+            response = await client.post(
+                '/strapi/webhook',
+                json={'event': 'entry.update', 'model': 'product',
+                      'entry': {'id': 3, 'title': 'Подделка'}},
+                headers={'Authorization': SECRET})
+            assert response.status == 200
+            # title is reloaded from strapi, payload is not trusted
+            await wait_for(lambda: [product.id for product in
+                                    index.search('осетр')] == [3])
+            assert index.search('подделка') == []
+
+            del mock_strapi.products[5]
+            response = await client.post(
+                '/strapi/webhook',
+                json={'event': 'entry.delete', 'model': 'product',
+                      'entry': {'id': 5}},
+                headers={'Authorization': SECRET})
+            assert response.status == 200
+            await wait_for(lambda: len(index) == 29)
+
+        await index.stop()
+        await strapi.close()
+
+
+def test_webhook_reloads_product_in_index():
+    asyncio.run(check_reload_by_webhook())
@@ -0,0 +1,68 @@
+import asyncio
+import aiohttp
+import pytest
+from strapi import CatalogCache, CircuitBreaker, is_retryable
+
+
+def test_circuit_breaker_opens_and_probes(clock):
+    breaker = CircuitBreaker(failures=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.closed and breaker.allow()
+
+    breaker.failure()
+    assert not breaker.closed
+    assert not breaker.allow()
+
+    clock.now += 30
+    # one probe, others fail fast until it ends
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.failure()
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.closed and breaker.allow()
+
+
+def test_circuit_breaker_success_resets_failures():
+    breaker = CircuitBreaker(failures=2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.closed
+
+
+def test_is_retryable():
+    def response_error(status: int) -> aiohttp.ClientResponseError:
+        return aiohttp.ClientResponseError(None, (), status=status)
+
+    assert is_retryable(response_error(503))
+    assert is_retryable(response_error(429))
+    assert not is_retryable(response_error(404))
+    assert is_retryable(aiohttp.ClientConnectionError())
+    assert is_retryable(asyncio.TimeoutError())
+    assert not is_retryable(ValueError())
+
+
+def test_catalog_cache_serves_expired_when_loader_fails(clock):
+    async def loader() -> str:
+        return 'catalog'
+
+    async def failing() -> str:
+        raise ConnectionError('strapi is down')
+
+    async def main() -> str:
+        cache = CatalogCache(ttl=60, stale_ttl=300)
+        await cache.get('page', loader)
+        clock.now += 1000
+        expired = await cache.get('page', failing)
+        # nothing to serve after invalidation
+        cache.invalidate()
+        with pytest.raises(ConnectionError):
+            await cache.get('page', failing)
+        return expired
+
+    assert asyncio.run(main()) == 'catalog'
@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import pytest
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp.test_utils import TestServer
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.mock_strapi import MockStrapi
+from benchmarks.run import callback_update
+from callbackdata_factory.callbacks import (ChangeQuantityCallback,
+                                           GalleryCallback,
+                                           PageGalleryCallback,
+                                           ProductCallback)
+from handlers.shop import shop
+from main import create_dispatcher, create_storage
+from memory_redis import MemoryRedis
+from strapi import Strapi
+
+
+@pytest.fixture(autouse=True)
+def bot_env(monkeypatch, tmp_path) -> None:
+    monkeypatch.setenv('PAGINATION', '5')
+    monkeypatch.setenv('FSM_STORAGE', 'redis')
+    monkeypatch.setenv('IMAGE_CACHE_DIR', str(tmp_path))
+
+
+@contextlib.asynccontextmanager
+async def shop_bot(mock_strapi: MockStrapi, fake_telegram: FakeTelegram):
+    """Feed of updates to the bot running on MockStrapi and FakeTelegram"""
+    async with TestServer(mock_strapi.create_app()) as strapi_server, \
+            TestServer(fake_telegram.create_app()) as telegram_server:
+        strapi = Strapi(token='test',
+                        api_url=str(strapi_server.make_url('/api/')))
+        redis = MemoryRedis()
+        dp = create_dispatcher(create_storage(redis), strapi, redis,
+                               prewarm=False)
+        bot = Bot('42:test', session=AiohttpSession(
+            api=TelegramAPIServer.from_base(
+                str(telegram_server.make_url('')).rstrip('/'))))
+        await dp.emit_startup(bot=bot, **dp.workflow_data)
+        updates = iter(range(1, 10 ** 6))
+
+        async def feed(data: str) -> None:
+            await dp.feed_raw_update(
+                bot, callback_update(next(updates), 1, data))
+
+        try:
+            yield feed
+        finally:
+            await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+            await bot.session.close()
+            # the router is a module object, the next test attaches it
+            dp.sub_routers.remove(shop)
+            shop._parent_router = None
+
+
+@pytest.mark.parametrize('picture', [None, {'data': None}, {'data': []}])
+def test_product_without_picture_gets_text_card(picture):
+    mock_strapi = MockStrapi(products=3)
+    mock_strapi.products[1]['attributes']['picture'] = picture
+    fake_telegram = FakeTelegram()
+
+    async def main() -> None:
+        async with shop_bot(mock_strapi, fake_telegram) as feed:
+            await feed(ProductCallback(id=1).pack())
+            await feed(GalleryCallback(id_product=1).pack())
+
+    asyncio.run(main())
+    assert fake_telegram.calls['sendMessage'] == 1
+    assert fake_telegram.calls['answerCallbackQuery'] == 1
+    assert not fake_telegram.calls['sendPhoto']
+    assert not fake_telegram.calls['sendMediaGroup']
+
+
+def test_stale_file_id_of_product_card_is_uploaded_again():
+    mock_strapi = MockStrapi(products=3)
+    fake_telegram = FakeTelegram()
+
+    async def main() -> None:
+        async with shop_bot(mock_strapi, fake_telegram) as feed:
+            await feed(ProductCallback(id=1).pack())
+            fake_telegram.invalid_file_ids.add('photo_1')
+            await feed(ProductCallback(id=1).pack())
+            await feed(ProductCallback(id=1).pack())
+
+    asyncio.run(main())
+    # upload, refused file_id and upload, new file_id
+    assert fake_telegram.calls['sendPhoto'] == 4
+    assert fake_telegram.uploads == 2
+
+
+def test_stale_file_ids_of_gallery_are_uploaded_again():
+    mock_strapi = MockStrapi(products=3)
+    fake_telegram = FakeTelegram()
+
+    async def main() -> None:
+        async with shop_bot(mock_strapi, fake_telegram) as feed:
+            await feed(PageGalleryCallback(page=1).pack())
+            uploads = fake_telegram.uploads
+            fake_telegram.invalid_file_ids.update(
+                'photo_{}'.format(index) for index in range(1, uploads + 1))
+            await feed(PageGalleryCallback(page=1).pack())
+            assert fake_telegram.uploads == 2 * uploads
+            await feed(PageGalleryCallback(page=1).pack())
+            assert fake_telegram.uploads == 2 * uploads
+
+    asyncio.run(main())
+    assert fake_telegram.calls['sendMediaGroup'] == 4
+
+
+def test_forged_quantity_delta_is_ignored():
+    mock_strapi = MockStrapi(products=3)
+    fake_telegram = FakeTelegram()
+
+    async def main() -> None:
+        async with shop_bot(mock_strapi, fake_telegram) as feed:
+            await feed(ChangeQuantityCallback(id_product=1, delta=100).pack())
+            assert not fake_telegram.calls['answerCallbackQuery']
+            await feed(ChangeQuantityCallback(id_product=1, delta=1).pack())
+            assert fake_telegram.calls['answerCallbackQuery'] == 1
+
+    asyncio.run(main())
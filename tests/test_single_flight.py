@@ -0,0 +1,53 @@
+import asyncio
+from strapi import SingleFlight
+
+
+def test_single_flight_shares_call():
+    calls = []
+
+    async def load() -> int:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 42
+
+    async def main() -> list:
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do('key', load)
+                                         for _ in range(5)))
+        # finished call is forgotten
+        results.append(await flights.do('key', load))
+        return results
+
+    assert asyncio.run(main()) == [42] * 6
+    assert len(calls) == 2
+
+
+def test_single_flight_cancelled_caller_keeps_call():
+    async def load() -> str:
+        await asyncio.sleep(0.01)
+        return 'done'
+
+    async def main() -> str:
+        flights = SingleFlight()
+        first = asyncio.create_task(flights.do('key', load))
+        second = asyncio.create_task(flights.do('key', load))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == 'done'
+
+
+def test_single_flight_shares_error():
+    async def load() -> None:
+        await asyncio.sleep(0)
+        raise ValueError('failed')
+
+    async def main() -> list:
+        flights = SingleFlight()
+        return await asyncio.gather(flights.do('key', load),
+                                    flights.do('key', load),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
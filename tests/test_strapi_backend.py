@@ -0,0 +1,13 @@
+import pytest
+from strapi import StrapiBackend
+
+
+@pytest.mark.parametrize('api_url, media_url', [
+    ('http://localhost:1337/api/', 'http://localhost:1337'),
+    ('http://strapi-api/api/', 'http://strapi-api'),
+    ('https://cms.example.com/strapi/api', 'https://cms.example.com/strapi'),
+    ('http://api.example.com/api/', 'http://api.example.com'),
+    ('http://host/myapi/', 'http://host/myapi'),
+])
+def test_media_url_drops_api_suffix_only(api_url, media_url):
+    assert StrapiBackend(api_url, 'token').media_url == media_url
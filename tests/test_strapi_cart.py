@@ -0,0 +1,49 @@
+import asyncio
+from aiohttp.test_utils import TestServer
+from benchmarks.mock_strapi import MockStrapi
+from strapi import Strapi
+
+
+async def check_upsert(mock_strapi: MockStrapi) -> list:
+    async with TestServer(mock_strapi.create_app()) as server:
+        strapi = Strapi(token='test', api_url=str(server.make_url('/api/')),
+                        cart_upsert_path='carts/add-product')
+        results = []
+        async with strapi:
+            for delta in (1, 1, -2):
+                results.append(await strapi.change_product_quantity(
+                    product_id=7, user_id=42, delta=delta))
+        await strapi.close()
+        return results
+
+
+def test_upsert_endpoint_changes_quantity_and_deletes_line_at_zero():
+    mock_strapi = MockStrapi(products=10)
+    (cart, line, first), (_, _, second), (_, _, last) = asyncio.run(
+        check_upsert(mock_strapi))
+    assert (first, second, last) == (1, 2, 0)
+    assert mock_strapi.carts[cart]['id_tg'] == 42
+    assert line not in mock_strapi.lines
+    # one request per change, no reads
+    assert mock_strapi.calls == {'POST /api/carts/add-product': 3}
+
+
+async def check_checkout(mock_strapi: MockStrapi) -> None:
+    async with TestServer(mock_strapi.create_app()) as server:
+        strapi = Strapi(token='test', api_url=str(server.make_url('/api/')),
+                        checkout_path='carts/checkout')
+        async with strapi:
+            for _ in range(2):
+                await strapi.checkout(id_cart=1, user_id=1,
+                                      email='user@mail.ru', total_price=500,
+                                      idempotency_key='1:1')
+        await strapi.close()
+
+
+def test_checkout_repeated_with_same_key_places_one_order():
+    mock_strapi = MockStrapi(products=10, users=1)
+    asyncio.run(check_checkout(mock_strapi))
+    assert list(mock_strapi.orders) == ['1:1']
+    assert mock_strapi.calls['POST /api/carts/checkout'] == 2
+    cart = mock_strapi.carts[1]
+    assert not cart['published'] and cart['email'] == 'user@mail.ru'
@@ -0,0 +1,54 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from benchmarks.mock_strapi import MockStrapi
+from strapi import Strapi
+from webhooks.strapi_webhook import setup_strapi_webhook
+
+SECRET = 'webhook-secret'
+
+
+async def check_webhook() -> None:
+    mock_strapi = MockStrapi(products=3)
+    async with TestServer(mock_strapi.create_app()) as strapi_server:
+        strapi = Strapi(token='test',
+                        api_url=str(strapi_server.make_url('/api/')))
+        events = []
+        strapi.add_catalog_listener(events.append)
+        async with strapi:
+            first = await strapi.get_product_page(1, 10)
+        mock_strapi.products[1]['attributes']['title'] = 'Осетр'
+
+        app = web.Application()
+        setup_strapi_webhook(app, strapi, '/strapi/webhook', SECRET)
+        async with TestClient(TestServer(app)) as client:
+            event = {'event': 'entry.update', 'model': 'product',
+                     'entry': {'id': 1}}
+            response = await client.post('/strapi/webhook', json=event)
+            assert response.status == 401
+            assert events == []
+
+            version = strapi.catalog_version
+            response = await client.post(
+                '/strapi/webhook', json=event,
+                headers={'Authorization': SECRET})
+            assert response.status == 200
+            assert events == [event]
+            assert strapi.catalog_version == version + 1
+
+            response = await client.post(
+                '/strapi/webhook',
+                json={'event': 'entry.update', 'model': 'cart'},
+                headers={'Authorization': SECRET})
+            assert response.status == 200
+            assert len(events) == 1
+
+        async with strapi:
+            page = await strapi.get_product_page(1, 10)
+        assert first.rows[0].title == 'Товар 1'
+        assert page.rows[0].title == 'Осетр'
+        await strapi.close()
+
+
+def test_webhook_invalidates_catalog():
+    asyncio.run(check_webhook())
@@ -0,0 +1,63 @@
+import hmac
+import logging
+from aiohttp import web
+from strapi import Strapi
+
+logger = logging.getLogger(__name__)
+
+CATALOG_MODELS = {'product'}
+
+
+def setup_strapi_webhook(app: web.Application,
+                         strapi: Strapi,
+                         path: str,
+                         secret: str) -> None:
+    """
+    Register endpoint for strapi lifecycle webhooks,
+     catalog cache is evicted on product and media events,
+     the payload is passed on to update search index in place
+    :param app: aiohttp application
+    :param strapi: Strapi client or WorkerPool which cache is evicted
+    :param path: url path configured in strapi webhook settings
+    :param secret: value of Authorization header sent by strapi,
+     required, the endpoint changes what users see in search
+    :return: None
+    """
+    if not secret:
+        raise ValueError('Strapi webhook needs STRAPI_WEBHOOK_SECRET')
+
+    async def strapi_webhook(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode(),
+                secret.encode()):
+            raise web.HTTPUnauthorized()
+        try:
+            event = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+        if (event.get('model') in CATALOG_MODELS
+                or str(event.get('event', '')).startswith('media.')):
+            strapi.invalidate_catalog(event)
+            logger.info('Catalog cache invalidated by %s',
+                        event.get('event'))
+        return web.json_response({'ok': True})
+
+    app.router.add_post(path, strapi_webhook)
+
+
+class WebAppRunner:
+    """Runs aiohttp application next to the bot polling"""
+
+    def __init__(self, app: web.Application,
+                 host: str = '0.0.0.0', port: int = 8080) -> None:
+        self._runner = web.AppRunner(app)
+        self._host = host
+        self._port = port
+
+    async def start(self) -> None:
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
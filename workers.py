@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+from multiprocessing.process import BaseProcess
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+
+def user_id_of(update: Update) -> int:
+    """Telegram id of user who sent update, update_id for service updates"""
+    try:
+        user = getattr(update.event, 'from_user', None)
+    except Exception:
+        user = None
+    if user is None:
+        return update.update_id
+    return user.id
+
+
+class WorkerPool:
+    """
+    Runs N worker processes sharing redis FSM storage. Updates are polled
+    in the main process and routed to a worker by user id, so updates of
+    one user are handled in order. Dead workers are restarted.
+    """
+
+    def __init__(self, workers: int, supervise_interval: float = 1.0) -> None:
+        """
+        :param workers: count of worker processes
+        :param supervise_interval: seconds between liveness checks
+        """
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes: list[BaseProcess | None] = [None] * workers
+        self._supervise_interval = supervise_interval
+
+    def start(self) -> None:
+        for index in range(len(self._processes)):
+            self._start_worker(index)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def dispatch(self, update: Update) -> None:
+        """Send update to the worker owning its user"""
+        user_id = user_id_of(update)
+        self._queues[user_id % len(self._queues)].put(
+            ('update', user_id,
+             update.model_dump(mode='json', exclude_unset=True)))
+
+    def invalidate_catalog(self, event: dict | None = None) -> None:
+        """Drop catalog cache in every worker, called by strapi webhook"""
+        for worker_queue in self._queues:
+            worker_queue.put(('invalidate_catalog', event))
+
+    async def supervise(self) -> None:
+        """Restart workers which exited, their pending updates are kept"""
+        while True:
+            await asyncio.sleep(self._supervise_interval)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.warning('Worker %s exited with code %s, restart',
+                                   index, process.exitcode)
+                    # dead worker may hold the queue read lock forever
+                    dead_queue = self._queues[index]
+                    self._queues[index] = self._context.Queue()
+                    # no await before the move, dispatch can not put
+                    # a newer update ahead of pending ones
+                    self._move_pending(index, dead_queue)
+                    self._start_worker(index)
+
+    def _move_pending(self, index: int,
+                      dead_queue: multiprocessing.Queue,
+                      timeout: float = 0.1) -> None:
+        """
+        Move updates left in queue of dead worker to its new queue.
+        Updates being handled when it died are lost
+        :param index: index of worker
+        :param dead_queue: queue of dead worker
+        :param timeout: seconds to wait for read lock and next item
+        """
+        moved = 0
+        while True:
+            try:
+                item = dead_queue.get(True, timeout)
+            except queue.Empty:
+                break
+            except Exception as error:
+                logger.error('Queue of worker %s is broken: %r', index, error)
+                break
+            # new worker loads catalog itself, stop is not pending here
+            if item is not None and item[0] == 'update':
+                self._queues[index].put(item)
+                moved += 1
+        try:
+            lost = dead_queue.qsize()
+        except NotImplementedError:
+            lost = None
+        if lost:
+            logger.error('Worker %s: %s updates lost with its queue',
+                         index, lost)
+        if moved:
+            logger.warning('Worker %s: %s pending updates moved to new queue',
+                           index, moved)
+        dead_queue.cancel_join_thread()
+        dead_queue.close()
+
+    async def run_polling(self, bot: Bot, allowed_updates: list[str],
+                          timeout: int = 30) -> None:
+        """Long polling in the main process, handling is done by workers"""
+        self.start()
+        supervisor = asyncio.create_task(self.supervise())
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset,
+                        timeout=timeout,
+                        allowed_updates=allowed_updates)
+                except Exception as error:
+                    logger.error('Failed to fetch updates: %r', error)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    self.dispatch(update)
+                    offset = update.update_id + 1
+        finally:
+            supervisor.cancel()
+            await bot.session.close()
+            self.stop()
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self._queues[index]),
+            name='shopbot-worker-{}'.format(index),
+            daemon=True)
+        process.start()
+        self._processes[index] = process
+
+
+def run_worker(index: int, updates: multiprocessing.Queue) -> None:
+    """Entry point of worker process"""
+    load_dotenv('.env')
+    logging.basicConfig(
+        format='%(asctime)s - worker {} - %(name)s - %(levelname)s - '
+               '%(message)s'.format(index),
+        level=logging.INFO,
+        stream=sys.stdout
+    )
+    asyncio.run(_worker_loop(index, updates))
+
+
+async def _worker_loop(index: int, updates: multiprocessing.Queue) -> None:
+    from main import (create_bot, create_dispatcher, create_storage,
+                      create_strapi, configure_metrics, serve_metrics)
+
+    configure_metrics()
+    # FSM_STORAGE=memory is refused in the main process
+    storage = create_storage()
+    bot = create_bot()
+    strapi = create_strapi()
+    # workers share the image directory, one downloads and prunes it
+    dp = create_dispatcher(storage, strapi, storage.redis,
+                           prewarm=index == 0)
+    if os.getenv('METRICS_PORT'):
+        # every worker exposes own metrics on the next ports
+        serve_metrics(dp, int(os.getenv('METRICS_PORT')) + 1 + index)
+    loop = asyncio.get_running_loop()
+    last_tasks: dict[int, asyncio.Task] = {}
+
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    try:
+        while True:
+            try:
+                item = await loop.run_in_executor(None, updates.get, True, 1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            if item[0] == 'invalidate_catalog':
+                strapi.invalidate_catalog(item[1])
+                continue
+            _, user_id, raw_update = item
+            task = asyncio.create_task(_feed_in_order(
+                dp, bot, raw_update, last_tasks.get(user_id)))
+            last_tasks[user_id] = task
+            task.add_done_callback(
+                lambda done, user_id=user_id: _forget_task(
+                    last_tasks, user_id, done))
+        if last_tasks:
+            await asyncio.wait(list(last_tasks.values()))
+    finally:
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+        await bot.session.close()
+
+
+async def _feed_in_order(dp: Dispatcher, bot: Bot, raw_update: dict,
+                         previous: asyncio.Task | None) -> None:
+    """Handle update after previous update of the same user"""
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dp.feed_raw_update(bot, raw_update)
+    except Exception:
+        logger.exception('Failed to handle update')
+
+
+def _forget_task(last_tasks: dict[int, asyncio.Task], user_id: int,
+                 task: asyncio.Task) -> None:
+    if last_tasks.get(user_id) is task:
+        del last_tasks[user_id]